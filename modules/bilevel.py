@@ -0,0 +1,65 @@
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+
+def is_bilevel(gray, original=None):
+    """
+    description:
+      whether a page is two-tone, i.e. only black (0) and white (255), as decoded from 1-bit scans (CCITT fax, 1-bit tiff or png), in a single pass over the grayscale page, and over the original too if it is RGB (e.g. embedded scans, see render_page). RGBA pages are never bilevel, as they have transparency
+    args:
+      gray: numpy array, the grayscale page
+      original: numpy array, optional, the page gray was converted from
+    """
+    if original is not None and original.ndim == 3:
+        if original.shape[2] != 3:
+            return False
+        # a pixel of 0 or 255 channels is gray only if it is black or white, other mixes have gray levels between
+        channels = original.reshape(original.shape[0], -1)
+        if cv.countNonZero(cv.inRange(channels, 1, 254)) != 0:
+            return False
+    return cv.countNonZero(cv.inRange(gray, 1, 254)) == 0
+
+
+def binarize(gray):
+    # threshold a grayscale page in place into black and white, by Otsu's threshold as in the detection
+    cv.threshold(gray, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU, dst=gray)
+    return gray
+
+
+class BitImage:
+    """
+    description:
+      A black and white image kept bit-packed, 8 pixels per byte, rows padded to whole bytes, i.e. 8 times less memory than a gray uint8 array. It is unpacked only when encoded, as a 1-bit PIL image, see ImageWriter
+
+    args:
+      bits: numpy array, (h, ceil(w / 8)) uint8, the rows packed by np.packbits, set bits are white
+      width: int, the width in pixels
+
+    attribute:
+      shape: (h, w), as the gray array it stands for
+    """
+
+    def __init__(self, bits, width):
+        self.bits = bits
+        self.width = width
+        self.shape = (bits.shape[0], width)
+
+    @classmethod
+    def from_array(cls, gray):
+        # pack a black and white uint8 array, every pixel not black is white
+        return cls(np.packbits(gray > 127, axis=1), gray.shape[1])
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_image(self):
+        # a 1-bit PIL image, read from the packed rows, which are the raw layout of PIL mode "1"
+        return Image.frombuffer(
+            "1", (self.width, self.shape[0]), self.bits, "raw", "1", 0, 1
+        )
+
+    def to_array(self):
+        # the gray uint8 array, 0 or 255
+        return np.unpackbits(self.bits, axis=1, count=self.width) * np.uint8(255)
@@ -0,0 +1,164 @@
+import os
+import hashlib
+import zipfile
+import numpy as np
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    description:
+      content hash of a file, used to key the cache so that a changed pdf never hits stale entries
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+class LRUDirectory:
+    """
+    description:
+      A flat directory of cache files with size based LRU eviction. The modification time of a file is its last use, it is refreshed on every hit, and the least recently used files are removed once the directory grows over max_bytes. Files are written to a temporary name and renamed, so that several processes can share the directory.
+
+    args:
+      root: str, path to the directory, created if not exist
+      max_bytes: int, the size budget of the directory
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def hit(self, name):
+        # return the path of a cached file and mark it as recently used, or None on a miss
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def commit(self, tmp_path, name):
+        os.replace(tmp_path, self.path(name))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            total -= size
+
+
+class PageCache:
+    """
+    description:
+      A two layer on-disk cache for re-runs over the same pdf
+        1. rendered pages, keyed by pdf hash, page number and dpi
+        2. detection results (all contours, their hierarchy and the threshold level), keyed additionally by the detection parameters
+      so that a re-run with other thresholds, mode or padding skips rendering and detection, while only the cheap filtering and cropping are redone
+
+    args:
+      cache_dir: str, path to the cache folder, the folder will be created if not exist
+      page_bytes: int, size budget of the rendered pages, the default holds a catalogue of 2000 colour pages at 600dpi. Pages are stored compressed, measured on the test pdfs a gray rubbing page takes about 0.5MB (69MB uncompressed) and a colour photo page about 22MB (77MB uncompressed)
+      detection_bytes: int, size budget of the detection results
+    """
+
+    def __init__(self, cache_dir, page_bytes=48 << 30, detection_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.pages = LRUDirectory(os.path.join(cache_dir, "pages"), page_bytes)
+        self.detections = LRUDirectory(
+            os.path.join(cache_dir, "detections"), detection_bytes
+        )
+
+    @staticmethod
+    def page_key(pdf_hash, page_num, dpi):
+        return f"{pdf_hash}-{page_num}-{dpi}"
+
+    @staticmethod
+    def detection_key(page_key, **params):
+        # every parameter that changes the contours found on the page goes into the key
+        params = "".join(f"-{k}{v}" for k, v in sorted(params.items()))
+        return f"{page_key}{params}"
+
+    def load_page(self, key):
+        path = self.pages.hit(f"{key}.npz")
+        if path is None:
+            return None
+        try:
+            # the array is given to RubbingCropper as is, without a PIL copy in between
+            with np.load(path) as data:
+                return data["page"]
+        except (
+            FileNotFoundError,
+            ValueError,
+            OSError,
+            KeyError,
+            zipfile.BadZipFile,
+        ):
+            return None  # evicted or truncated in the meantime, treat as a miss
+
+    def save_page(self, key, img):
+        # lossless zlib compression, the white margins and the gray pages stored as RGB shrink about 100 times, colour photos 3 to 4 times
+        tmp_path = self.pages.path(f"{key}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, page=np.asarray(img))
+        self.pages.commit(tmp_path, f"{key}.npz")
+
+    def load_detection(self, key):
+        path = self.detections.hit(f"{key}.npz")
+        if path is None:
+            return None
+        try:
+            with np.load(path) as data:
+                points, lengths, hierarchy = (
+                    data["points"],
+                    data["lengths"],
+                    data["hierarchy"],
+                )
+                # entries written before the level was cached have none, it is then computed again when needed
+                level = float(data["level"]) if "level" in data.files else None
+        except (
+            FileNotFoundError,
+            ValueError,
+            OSError,
+            KeyError,
+            zipfile.BadZipFile,
+        ):
+            return None
+        contours = ()
+        if len(lengths):
+            contours = tuple(np.split(points, np.cumsum(lengths)[:-1]))
+        return contours, (hierarchy if hierarchy.size else None), level
+
+    def save_detection(self, key, detection):
+        contours, hierarchy, *level = detection
+        lengths = np.array([len(cnt) for cnt in contours], dtype=np.int64)
+        points = (
+            np.concatenate(contours)
+            if len(contours)
+            else np.zeros((0, 1, 2), dtype=np.int32)
+        )
+        if hierarchy is None:
+            hierarchy = np.zeros((1, 0, 4), dtype=np.int32)
+        tmp_path = self.detections.path(f"{key}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            arrays = dict(points=points, lengths=lengths, hierarchy=hierarchy)
+            if level and level[0] is not None:
+                arrays["level"] = np.float64(level[0])
+            np.savez(f, **arrays)
+        self.detections.commit(tmp_path, f"{key}.npz")
@@ -1,200 +1,750 @@
+import io
+import os
 import cv2 as cv
 import numpy as np
-from math import *
 from PIL import Image
 
+from .bilevel import BitImage, binarize, is_bilevel
+from .metrics import timed
+
+# size of the erosion kernel used by the detection, in pixels
+KERNEL_SIZE = 21
+
 
 # a quick and simple version of RGBA outline extractor and masking using invert mask
-def convert_alpha(masked, outline):
+def convert_alpha(masked, outline, offset=(0, 0)):
     # create a blank rgba canvas with transparent background
     # mask the canvas with the outline with black untransparent bg (inverted mask)
     # let the alpha channel of invert masked image also be 0
     # concatenate the masked and the rgba canvas
+    # offset is added to the outline points, pass (-x, -y) when masked is a region of interest starting at (x, y)
     rgba_canvas = np.zeros((masked.shape[0], masked.shape[1], 4), dtype=np.uint8) + 255
     rgba_canvas[:, :, 3] = 0
-    cv.fillPoly(rgba_canvas, [outline], (0, 0, 0, 255))
+    cv.fillPoly(rgba_canvas, [outline], (0, 0, 0, 255), offset=offset)
     # if the input is a gray image, convert it to rgba
     if len(masked.shape) == 2:
         masked2 = cv.cvtColor(masked, cv.COLOR_GRAY2RGBA)
     # if is rgb, convert it to rgba
     elif len(masked.shape) == 3 and masked.shape[2] == 3:
         masked2 = cv.cvtColor(masked, cv.COLOR_RGB2RGBA)
-    # if is rgba, do nothing
+    # if is rgba, copy it so that the alpha channel of the caller's image is left untouched
     elif len(masked.shape) == 3 and masked.shape[2] == 4:
-        masked2 = masked
+        masked2 = masked.copy()
     masked2[:, :, 3] = 0  # change alpha channel to 0
     new = cv.add(rgba_canvas, masked2)
     return new
 
 
+def detection_factor(scale):
+    # the integer factor the page is shrunk by for a detection scale
+    if not scale > 0:
+        raise ValueError(f"Invalid detect_scale {scale}, must be positive")
+    return max(1, round(1 / scale))
+
+
+def erode_page(gray, factor=1, metrics=None):
+    """
+    description:
+      the page eroded for the detection, at full resolution, or shrunk by the integer factor with a kernel shrunk to match
+    """
+    if factor > 1:
+        # shrink by min pooling, i.e. an erosion by the factor followed by subsampling, so that thin dark outlines survive the downscale
+        with timed(metrics, "downscale"):
+            offset = factor // 2
+            small = cv.erode(gray, np.ones((factor, factor), np.uint8))
+            small = np.ascontiguousarray(small[offset::factor, offset::factor])
+    else:
+        small = gray
+    kernel = max(1, round(KERNEL_SIZE / factor))
+    # erode by a large kernel to merge smaller bounding boxes to cut computation, and to distinguish the tracing outlines
+    with timed(metrics, "erode"):
+        return cv.erode(small, np.ones((kernel, kernel), np.uint8), iterations=1)
+
+
+def detect_contours(gray, scale=1, metrics=None, bilevel=False):
+    """
+    description:
+      the expensive part of the detection, erode and binarize the grayscale page, and find all the contours on it
+    args:
+      gray: numpy array, the grayscale page
+      scale: float, detection scale, below 1 the detection runs on a page shrunk by the integer factor round(1 / scale) with a kernel shrunk to match, and the contours are mapped back to full resolution, to be refined by refine_contour once selected
+      metrics: PageMetrics, optional, collects the time of every step
+      bilevel: bool, whether the page is only black (0) and white (255), see is_bilevel. The eroded page is then black and white too, and already the binary one for any Otsu level (which is below 255), so it is thresholded in place, one page less in memory
+    returns:
+      (eroded, binary, contours, hierarchy, level), eroded and binary are at the detection scale, the same array for a bilevel page, contours are always in full resolution page pixels, level is the Otsu threshold of the eroded page
+    """
+    factor = detection_factor(scale)
+    eroded = erode_page(gray, factor, metrics)
+    # a simple thresholding will do， as the image quality is quite good, otherwise, consider Canny instead
+    with timed(metrics, "threshold"):
+        level, binary = cv.threshold(
+            eroded,
+            127,
+            255,
+            cv.THRESH_BINARY + cv.THRESH_OTSU,
+            dst=eroded if bilevel else None,
+        )
+    with timed(metrics, "find_contours"):
+        contours, hierarchy = cv.findContours(
+            binary, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
+        )
+    if factor > 1:
+        # map every point back to the center of its block, clipped to the page, text thresholds then keep their full resolution meaning
+        upper = np.array([gray.shape[1] - 1, gray.shape[0] - 1])
+        contours = tuple(
+            np.clip(cnt * factor + (factor - 1) // 2, 0, upper).astype(np.int32)
+            for cnt in contours
+        )
+    return eroded, binary, contours, hierarchy, level
+
+
+def detection_level(gray, scale=1, metrics=None):
+    # the Otsu threshold of a detection, e.g. for refining a detection loaded from cache without it
+    eroded = erode_page(gray, detection_factor(scale), metrics)
+    return cv.threshold(eroded, 127, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)[0]
+
+
+def refine_contour(gray, cnt, factor, level, outer=False):
+    """
+    description:
+      the full resolution outline of an object detected on a shrunk page, whose mapped contour is only accurate to the factor. The region around it is eroded with the full kernel, thresholded with the level of the detection and its contours found, as on the full resolution page, and the one closest to the mapped contour is kept. The region grows until it holds the whole outline
+    args:
+      gray: numpy array, the full resolution grayscale page
+      cnt: numpy array, the mapped contour, see detect_contours
+      factor: int, see detection_factor
+      level: float, the threshold of the detection, see detect_contours
+      outer: bool, the object is the outer outline of a white component (the colour image fallback of select_contours) rather than the hole of a dark one
+    returns:
+      numpy array, the refined contour, or cnt itself if the region has no outline of the kind
+    """
+    height, width = gray.shape[:2]
+    halo = KERNEL_SIZE // 2
+    kernel = np.ones((KERNEL_SIZE, KERNEL_SIZE), np.uint8)
+    box = np.array(cv.boundingRect(cnt))
+    x, y, w, h = box
+    margin = 2 * factor
+    while True:
+        x0, y0 = max(0, x - margin), max(0, y - margin)
+        x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+        # the halo of the kernel makes the erosion of the region the one of the whole page
+        left, top = max(0, x0 - halo), max(0, y0 - halo)
+        region = gray[top : min(height, y1 + halo), left : min(width, x1 + halo)]
+        eroded = cv.erode(region, kernel)[y0 - top : y1 - top, x0 - left : x1 - left]
+        binary = cv.threshold(eroded, level, 255, cv.THRESH_BINARY)[1]
+        # findContours sees black around the page, and white is assumed around the region inside the page, so that cut dark components show up as holes touching its border
+        binary = cv.copyMakeBorder(
+            binary, 1, 1, 1, 1, cv.BORDER_CONSTANT, value=0 if outer else 255
+        )
+        if not outer:
+            binary[:, 0] = 0 if x0 == 0 else 255
+            binary[:, -1] = 0 if x1 == width else 255
+            binary[0] = 0 if y0 == 0 else 255
+            binary[-1] = 0 if y1 == height else 255
+        contours, hierarchy = cv.findContours(
+            binary, cv.RETR_CCOMP, cv.CHAIN_APPROX_SIMPLE, offset=(x0 - 1, y0 - 1)
+        )
+        if len(contours) == 0:
+            return cnt
+        # outer outlines have no parent, holes have one
+        candidates = np.flatnonzero((hierarchy[0][:, 3] == -1) == outer)
+        if len(candidates) == 0:
+            return cnt
+        rects = contour_rects([contours[i] for i in candidates])
+        edges = np.concatenate([rects[:, :2], rects[:, :2] + rects[:, 2:]], 1)
+        target = np.concatenate([box[:2], box[:2] + box[2:]])
+        best = int(np.abs(edges - target).max(1).argmin())
+        bx0, by0, bx1, by1 = edges[best]
+        # an outer outline runs on the component itself, a hole on the white pixels around it, in the border added for a cut component
+        reach = 1 if outer else 0
+        if (
+            (bx0 < x0 + reach and x0 > 0)
+            or (by0 < y0 + reach and y0 > 0)
+            or (bx1 > x1 - reach and x1 < width)
+            or (by1 > y1 - reach and y1 < height)
+        ):
+            margin *= 2  # the outline goes on outside the region
+            continue
+        return contours[candidates[best]]
+
+
+def find_objects(gray, threshold=(200, 150), color=False, scale=1):
+    """
+    description:
+      detect the outlines of the primary objects on a grayscale page
+    args:
+      gray: numpy array, the grayscale page
+      threshold: tuple, (int, int), see RubbingCropper
+      color: bool, whether the page comes from a colour image, where first-level contours have different parent index behavior
+      scale: float, detection scale, see detect_contours
+    returns:
+      (eroded, binary, contours), the eroded and binarized page, and the list of valid object contours
+    """
+    eroded, binary, contours, hierarchy, level = detect_contours(gray, scale)
+    factor = detection_factor(scale)
+    refine = None
+    if factor > 1:
+        refine = lambda cnt, outer: refine_contour(gray, cnt, factor, level, outer)
+    contours = select_contours(
+        contours, hierarchy, threshold, color, refine=refine, slack=2 * factor
+    )
+    return eroded, binary, contours
+
+
+def valid_rects(rects, threshold, ratio=5, slack=0):
+    """
+    description:
+      the size and width/height ratio filters of the objects, w / h < ratio is written as w < ratio * h to stay in integers
+    args:
+      slack: int, how far off the boxes may be, the boxes which may pass once refined pass, see refine_contour
+    """
+    w, h = rects[:, 2], rects[:, 3]
+    return ((w + slack > threshold[0]) | (h + slack > threshold[1])) & (
+        w - slack < ratio * (h + slack)
+    )
+
+
+def select_contours(
+    contours,
+    hierarchy,
+    threshold=(200, 150),
+    color=False,
+    rects=None,
+    ratio=5,
+    refine=None,
+    slack=0,
+):
+    """
+    description:
+      the cheap part of the detection, filter the contours found by detect_contours down to the primary objects and merge the nested ones
+    args:
+      rects: numpy array, optional contour_rects of the contours, computed once for selecting several times, see PageDetection
+      ratio: int, the maximum width / height ratio of an object, wider contours are titles or text lines
+      refine: function, optional, (contour, outer) -> contour, the full resolution outline of a contour of a shrunk page, see refine_contour. The contours passing the filters with slack are refined, then filtered again
+      slack: int, how far off the boxes of the contours may be before refine
+    returns:
+      list, the valid object contours
+    """
+    """
+      Following code get only the first level bone contours, and filter out the number texts. This are several considerations:
+        1. parent-child relationship in the hierarchy, only first level should be found, thus filtering out all oracle bone characters
+        2. contour width and height. Use a (width, height) threshold to tell between the bone tracings and the number texts. The condition should be "and" or "or". The "or" might work better.Though the title text must be filtered out. This can be done by examining height/width ratio.
+        3. Width/Height ratio, should not exceed 5 to filter out the title text and others. Could consider crop the title text before processing if needed.
+        4. (Optional, not implemented) Extent ratio of the contour area to the bounding rectangle area. Normally the width and height will suffice, but it might be hard to find the correct value and some bones might be very small. So, in that case, can consider use shape descriptors, as Text, being more block-like and rectangle-like, might have a higher extent ratio compared to irregular bone tracings.
+    """
+    # can also consider use NMS suppression algorithm to merge adjancent boxes, it might not be necessary in our case as text boxes are merged by erosion and bone tracings are singular
+
+    if rects is None:
+        rects = contour_rects(contours)
+    parents = hierarchy[0][:, 3] if len(contours) else np.zeros(0, dtype=np.int32)
+    if refine is None:
+        slack = 0
+
+    def pick(parent):
+        # the valid contours with the given parent, refined if needed
+        selected = np.flatnonzero(
+            valid_rects(rects, threshold, ratio, slack) & (parents == parent)
+        )
+        picked = [contours[i] for i in selected]
+        if refine is None:
+            return picked, rects[selected]
+        picked = [refine(cnt, parent == -1) for cnt in picked]
+        picked_rects = contour_rects(picked)
+        valid = valid_rects(picked_rects, threshold, ratio)
+        return [cnt for cnt, keep in zip(picked, valid) if keep], picked_rects[valid]
+
+    picked, picked_rects = pick(0)
+    # also make distinction between RGB and Gray images, where first-level contours have different parent index behavior
+    if color and len(picked) == 0:
+        picked, picked_rects = pick(-1)
+    # merge the child boxes manually in case the tracing outline is not closed
+    kept = nested_box_mask(picked_rects)
+    valid_contours = [cnt for cnt, keep in zip(picked, kept) if keep]
+    return valid_contours
+
+
+def contour_rects(contours):
+    """
+    description:
+      the bounding rectangles of all the contours, computed once
+    returns:
+      numpy array, (n, 4), the (x, y, w, h) of every contour
+    """
+    rects = np.zeros((len(contours), 4), dtype=np.int64)
+    for i, cnt in enumerate(contours):
+        rects[i] = cv.boundingRect(cnt)
+    return rects
+
+
+def nested_box_mask(rects):
+    """
+    description:
+      find the boxes which are not inside any other box, by sweeping the boxes sorted by their left edge and keeping only the boxes whose right edge is not passed yet as candidate containers.
+      Note that two identical boxes contain each other, hence both are dropped.
+    args:
+      rects: numpy array, (n, 4), (x, y, w, h) boxes
+    returns:
+      numpy array, (n,), True for the boxes to keep
+    """
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    x1, y1 = rects[:, 0], rects[:, 1]
+    x2, y2 = x1 + rects[:, 2], y1 + rects[:, 3]
+    keep = np.ones(len(rects), dtype=bool)
+    order = np.argsort(x1, kind="stable")
+    active = np.zeros(0, dtype=np.int64)
+    start = 0
+    while start < len(order):
+        # all the boxes sharing the same left edge join the candidates together, as they can contain each other
+        stop = start + 1
+        while stop < len(order) and x1[order[stop]] == x1[order[start]]:
+            stop += 1
+        group = order[start:stop]
+        active = np.concatenate([active, group])
+        # a box ending left of the current edge can not contain this or any later box
+        active = active[x2[active] >= x1[group[0]]]
+        for j in group:
+            containers = (
+                (x2[active] >= x2[j])
+                & (y1[active] <= y1[j])
+                & (y2[active] >= y2[j])
+                & (active != j)
+            )
+            keep[j] = not containers.any()
+        start = stop
+    return keep
+
+
+def merge_nested_contours(contours):
+    """
+    This function is designed to merge nested boxes if any, this might happen when the bone tracings are not completely closed. I currently have no idea how to close the contour manually as some of the open contours are broken in the middle and will not close no matter what.
+    """
+    kept = nested_box_mask(contour_rects(contours))
+    return [cnt for cnt, keep in zip(contours, kept) if keep]
+
+
+def crop_object(original, cnt, padding="white"):
+    """
+    description:
+      crop a single object out of the original page by its outline, on the bounding box region of the contour only
+    args:
+      original: numpy array, the original page, gray, RGB or RGBA
+      cnt: numpy array, the contour of the object in page coordinates
+      padding: str, "white", "black" or "transparent"
+    returns:
+      numpy array, the padded crop, RGBA if the padding is transparent, otherwise the same channels as the original
+    """
+    x, y, w, h = cv.boundingRect(cnt)
+    # give an extra 15% space around the new images, can add more if needed
+    cropped = convert_alpha(original[y : y + h, x : x + w], cnt, offset=(-x, -y))
+    if padding == "transparent":
+        padding_value = (255, 255, 255, 0)
+    elif padding == "black":
+        padding_value = (0, 0, 0, 255)
+    else:
+        padding_value = (255, 255, 255, 255)
+    cropped = cv.copyMakeBorder(
+        cropped,
+        int(h * 0.15),
+        int(h * 0.15),
+        int(w * 0.15),
+        int(w * 0.15),
+        cv.BORDER_CONSTANT,
+        value=padding_value,
+    )
+    # detect original image's shape and save the cropped image as either Gray, RGB, or RGBA
+    # if is transparent
+    if padding == "transparent":
+        cropped = cropped
+    else:
+        # if is gray
+        if len(original.shape) == 2:
+            cropped = cv.cvtColor(cropped, cv.COLOR_RGBA2GRAY)
+        # if is rgb
+        elif len(original.shape) == 3 and original.shape[2] == 3:
+            cropped = cv.cvtColor(cropped, cv.COLOR_RGBA2RGB)
+        # if is rgba
+        elif len(original.shape) == 3 and original.shape[2] == 4:
+            cropped = cropped
+    return cropped
+
+
+def whiten_object(gray, cnt, mode="poly"):
+    """
+    description:
+      replace a single object on the grayscale page with white background in place, on the bounding box region of the contour only
+    """
+    x, y, w, h = cv.boundingRect(cnt)
+    if mode == "poly":
+        # this is done by a binary mask of the box region, use full rather than zeros to create white background
+        mask = np.full((h, w), 255, dtype=np.uint8)
+        cv.drawContours(mask, [cnt], -1, 0, -1, offset=(-x, -y))
+        gray[y : y + h, x : x + w][mask == 0] = 255
+    else:
+        # a filled rectangle includes its bottom right corner, hence the extra pixel
+        gray[y : y + h + 1, x : x + w + 1] = 255
+
+
+class BufferReader(io.RawIOBase):
+    """
+    description:
+      a read-only, seekable file over a bytes-like object (bytes, bytearray, memoryview, mmap), so that an encoded image held in memory is decoded by PIL without being copied into a BytesIO first
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast("B")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.buffer[self.position : self.position + len(b)]
+        b[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.buffer)}
+        self.position = max(0, start[whence] + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+def rgb_to_gray(rgb, rows=1024):
+    """
+    description:
+      grayscale of an RGB or RGBA ndarray (e.g. a np.memmap), with the same weights and rounding as PIL convert("L"), so that arrays and files give the same detection. Done by chunks of rows, the input is only read
+    """
+    gray = np.empty(rgb.shape[:2], dtype=np.uint8)
+    weights = np.array([19595, 38470, 7471], dtype=np.uint32)
+    for y in range(0, rgb.shape[0], rows):
+        chunk = rgb[y : y + rows, :, :3].astype(np.uint32)
+        gray[y : y + rows] = (chunk @ weights + 0x8000) >> 16
+    return gray
+
+
+def decode_image(img):
+    """
+    description:
+      decode a PIL Image once into the original and the grayscale ndarray, other modes than gray, RGB and RGBA (bilevel, palette, 16 bits, CMYK...) are converted first, so that the crops keep the colours of the image
+    returns:
+      (original, gray), original is read-only, as it shares the buffer PIL exported it to, except for bilevel images, where both are the same new array, as for bilevel arrays in read_image
+    """
+    if img.mode == "1":
+        # a single 8-bit page, 0 or 255, the crops of a black and white image are the same from the gray page
+        gray = np.array(img.convert("L"))
+        return gray, gray
+    if img.mode not in ("L", "RGB", "RGBA"):
+        if img.mode in ("I", "I;16", "F"):
+            img = img.convert("L")
+        elif "A" in img.getbands() or "transparency" in img.info:
+            img = img.convert("RGBA")
+        else:
+            img = img.convert("RGB")
+    original = np.asarray(img)
+    if img.mode == "L":
+        return original, original.copy()
+    return original, np.array(img.convert("L"))
+
+
+def read_image(img_input, inplace=False):
+    """
+    description:
+      read the input of RubbingCropper into the original and the grayscale ndarray, decoding it once. The grayscale array is the one whitened by RubbingCropper, it is never an array of the caller unless inplace is set
+    args:
+      img_input: str or path-like, PIL Image, numpy array (np.memmap included), bytes-like object (bytes, bytearray, memoryview) holding an encoded image file, or binary file object
+      inplace: bool, use a gray uint8 ndarray input as the grayscale array itself instead of a copy, the caller's array is then whitened
+    returns:
+      (original, gray), gray is the same array as original with inplace
+    """
+    if isinstance(img_input, np.ndarray):
+        array = img_input
+        if array.ndim == 3 and array.shape[2] == 1:
+            array = array[:, :, 0]
+        if array.dtype == bool:
+            # a bilevel array, converted into a new array which can be whitened directly
+            array = array.astype(np.uint8) * 255
+            return array, array
+        if array.dtype != np.uint8 or not (
+            array.ndim == 2 or (array.ndim == 3 and array.shape[2] in (3, 4))
+        ):
+            raise ValueError(
+                f"Invalid input array of shape {img_input.shape} and type {img_input.dtype}, must be a uint8 gray (h, w), RGB (h, w, 3) or RGBA (h, w, 4) array"
+            )
+        if array.ndim == 3:
+            return array, rgb_to_gray(array)
+        if not inplace:
+            return array, array.copy()
+        if not array.flags.writeable:
+            raise ValueError("Invalid input array for inplace, the array is read-only")
+        return array, array
+    if isinstance(img_input, Image.Image):
+        return decode_image(img_input)
+    if isinstance(img_input, (str, os.PathLike)):
+        try:
+            with Image.open(img_input) as img:
+                return decode_image(img)
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                "Image file not found, make sure the path to the image is correct"
+            )
+    if isinstance(img_input, (bytes, bytearray, memoryview)):
+        img_input = BufferReader(img_input)
+    if hasattr(img_input, "read"):
+        with Image.open(img_input) as img:
+            return decode_image(img)
+    raise ValueError(
+        "Invalid input image type, must be a path string, PIL Image, numpy array, bytes-like object or binary file object"
+    )
+
+
+class PageDetection:
+    """
+    description:
+      The detection stage of RubbingCropper on its own: a page is decoded, eroded, thresholded and its contours found once, then objects can be selected with any threshold (select) and extracted with any mode and padding (Selection.extract) as many times as needed, e.g. for sweeping the parameters on a page:
+        detection = PageDetection("page.png")
+        for threshold in [(100, 50), (200, 100), (300, 150)]:
+            selection = detection.select(threshold)  # cheap, the contour rectangles are computed once
+            print(threshold, selection.boxes)
+        output = detection.select((200, 100)).extract("rect", "black")  # the same dict as RubbingCropper.output
+
+    args:
+      img_input: see RubbingCropper, decoded once and never modified unless inplace
+      detect_scale: float, see RubbingCropper
+      detection: tuple, (contours, hierarchy, level), optional result of detect_contours for the same page, see RubbingCropper
+      metrics: PageMetrics, optional, collects the time of every step
+      inplace: bool, see RubbingCropper, only an inplace extract whitens the caller's array
+      bilevel: bool or "auto", see RubbingCropper, pages are thresholded (when True) on their first extract
+      color: bool, optional, see RubbingCropper
+
+    attribute:
+      original, gray, eroded, binary, bilevel: see RubbingCropper
+      contours, hierarchy: all the contours found on the page before filtering
+      level: float, the Otsu threshold of the detection, None if the detection was given without it, it is then computed on the first select below detection scale 1
+      factor: int, the factor the page is shrunk by for the detection, see detection_factor
+      rects: numpy array, (n, 4), the bounding rectangles of all the contours
+      color: bool, whether the objects are selected as on a colour image, see select_contours
+    """
+
+    def __init__(
+        self,
+        img_input,
+        detect_scale=1,
+        detection=None,
+        metrics=None,
+        inplace=False,
+        bilevel=False,
+        color=None,
+    ):
+        if bilevel not in (True, False, "auto"):
+            raise ValueError(f'Invalid bilevel {bilevel!r}, must be True, False or "auto"')
+        self.metrics = metrics
+        self.factor = detection_factor(detect_scale)
+        # read image into grayscale ndarray
+        with timed(metrics, "decode"):
+            self.original, self.gray = read_image(img_input, inplace)
+        self.color = self.original.ndim == 3 if color is None else color
+        self.bilevel = False
+        self.force_bilevel = bilevel is True
+        if bilevel:
+            with timed(metrics, "bilevel"):
+                self.bilevel = is_bilevel(self.gray, self.original)
+            if self.bilevel:
+                # objects are all cropped before being whitened, so gray can be the original too, one page less in memory from the detection on
+                self.original = self.gray
+                if metrics is not None:
+                    metrics.count("bilevel")
+        if detection is None:
+            self.eroded, self.binary, *detection = detect_contours(
+                self.gray, detect_scale, metrics, self.bilevel
+            )
+        else:
+            # erosion and contour finding are skipped, e.g. when the detection is loaded from cache
+            self.eroded, self.binary = None, None
+        self.contours, self.hierarchy, *level = detection
+        self.level = level[0] if level else None
+        self.rects = contour_rects(self.contours)
+        self.consumed = False
+        self.binarized = False
+        if metrics is not None:
+            metrics.count("contours", len(self.contours))
+
+    def select(self, threshold=(200, 150), ratio=5):
+        """
+        description:
+          select the objects among the detected contours, see select_contours. Below detection scale 1, the outlines of the objects are refined on the full resolution page, see refine_contour, which must not be whitened or thresholded by an extract yet
+        returns:
+          Selection
+        """
+        refine = None
+        if self.factor > 1:
+            if self.consumed or self.binarized:
+                raise RuntimeError(
+                    "The page was whitened or thresholded by an extract, objects detected below scale 1 can not be refined on it"
+                )
+            if self.level is None:
+                self.level = detection_level(self.gray, 1 / self.factor, self.metrics)
+            refine = lambda cnt, outer: refine_contour(
+                self.gray, cnt, self.factor, self.level, outer
+            )
+        with timed(self.metrics, "select"):
+            contours = select_contours(
+                self.contours,
+                self.hierarchy,
+                threshold,
+                color=self.color,
+                rects=self.rects,
+                ratio=ratio,
+                refine=refine,
+                slack=2 * self.factor,
+            )
+        return Selection(self, contours)
+
+    def extract(self, contours, mode="poly", padding="white", page=True, inplace=False):
+        """
+        description:
+          crop the given objects out of the page, and whiten them on a copy of the grayscale page, see Selection.extract
+        """
+        if self.consumed:
+            raise RuntimeError(
+                "The page was whitened by an inplace extract, it can not be extracted again"
+            )
+        metrics = self.metrics
+        if self.force_bilevel and not self.bilevel:
+            # thresholded after the detection, so that it is the same as without bilevel
+            with timed(metrics, "bilevel"):
+                self.original = binarize(self.gray)
+            self.bilevel, self.binarized = True, True
+            if metrics is not None:
+                metrics.count("bilevel")
+        output = {}
+        imgs = []
+        # crop the bone tracings by their polygon outline rather than rectangles
+        with timed(metrics, "crop"):
+            for cnt in contours:
+                imgs.append(crop_object(self.original, cnt, padding))
+        gray = None
+        if page:
+            self.consumed = inplace
+            gray = self.gray if inplace else self.gray.copy()
+            # replace the original page image with white background where the bone tracings are, once every object is cropped, as gray may be the original itself
+            with timed(metrics, "whiten"):
+                for cnt in contours:
+                    whiten_object(gray, cnt, mode)
+        if self.bilevel:
+            with timed(metrics, "bilevel"):
+                imgs = [img if img.ndim == 3 else BitImage.from_array(img) for img in imgs]
+                output["page"] = BitImage.from_array(gray) if gray is not None else None
+        else:
+            output["page"] = gray
+        output["images"] = imgs
+        output["boxes"] = [cv.boundingRect(cnt) for cnt in contours]
+        return output
+
+
+class Selection:
+    """
+    description:
+      The objects selected on a page by PageDetection.select, extracted on demand
+
+    attribute:
+      detection: PageDetection
+      contours: list, the contours of the objects
+      boxes: list, their (x, y, w, h) bounding boxes
+    """
+
+    def __init__(self, detection, contours):
+        self.detection = detection
+        self.contours = contours
+        self.boxes = [cv.boundingRect(cnt) for cnt in contours]
+
+    def __len__(self):
+        return len(self.contours)
+
+    def extract(self, mode="poly", padding="white", page=True, inplace=False):
+        """
+        description:
+          crop the objects and whiten them on the page
+        args:
+          mode: str, "rect" or "poly", see RubbingCropper
+          padding: str, "white", "black" or "transparent"
+          page: bool, also return the page with the objects replaced by white background, skipping it saves a copy of the page
+          inplace: bool, whiten the grayscale page of the detection itself rather than a copy, which saves a page of memory, but the detection can not be extracted again
+        returns:
+          dict, {"images", "boxes", "page"}, see RubbingCropper.output, page is None if not requested
+        """
+        return self.detection.extract(self.contours, mode, padding, page, inplace)
+
+
 class RubbingCropper:
     """
     description:
-      A class for cropping bone tracings from an image input as seperate local files, and replace the bone contours with a white background, leaving only the numbers behind
+      A class for cropping bone tracings from an image input as seperate local files, and replace the bone contours with a white background, leaving only the numbers behind. It runs the detect, select and extract stages of PageDetection at once, use PageDetection directly to select and extract several times on the same page
 
     args:
-      img_input: str, PIL Image, or numpy array
+      img_input: str, PIL Image, numpy array (gray, RGB or RGBA, np.memmap included), bytes-like object holding an encoded image file, or binary file object, see read_image. The input is decoded once and never modified
       threshold: tuple, (int, int), the threshold for distinguishing the text and the bone, in width and height, those smaller than the threshold will be considered a number text
       mode: str, "rect" or "poly", the mode of cropping the bone tracings, "rect" will use the bounding rectangle of the contours, "poly" will use the polygon outline of the contours. Polygon will result in much higher precision cropping, however, it has problems with open contours. Rects is a better choice here.
+      detection: tuple, (contours, hierarchy, level), optional result of detect_contours for the same page, if given, erosion and contour finding are skipped. (contours, hierarchy) is accepted too, the level is then computed again below detect_scale 1
+      detect_scale: float, run erosion and contour finding on a page shrunk by this scale (e.g. 0.25), faster on high dpi pages. Only the outlines of the selected objects are then traced again on their region of the full resolution page, so that the boxes, crop masks and whitened outlines are those of the full resolution detection, up to the threshold level, which comes from the shrunk page
+      metrics: PageMetrics, optional, collects the time of every step (decode, erode, threshold, find_contours, select, crop, whiten) and the number of contours before and after filtering
+      inplace: bool, whiten the objects directly in a gray uint8 ndarray input instead of a copy of it, saving a page of memory, the caller's array becomes the page of the output
+      bilevel: bool or "auto", "auto" treats two-tone (only black and white) gray or RGB pages as bilevel, True treats every page as bilevel, thresholding the others into black and white once detected (colours are lost), False never does. The detection is the same either way. The crops and the page of a bilevel page are cropped from and whitened into a single buffer, and given as bit-packed BitImage (8 times less memory, written as 1-bit png or tiff G4), except crops with transparent padding which stay RGBA arrays
+      detect_only: bool, only detect the objects, without cropping or whitening them, for previewing or tuning the detection, the output then has no images and no page
+      color: bool, optional, whether the objects are selected as on a colour image, see select_contours, by default whether the decoded input is RGB or RGBA. Pdf pages are selected as colour pages, as pdfplumber renders them in RGB, including the gray and bilevel scans of the embedded backend, which are not expanded to RGB
 
     attribute:
+      original: the decoded page the objects are cropped from, the same array as gray (thus whitened) with inplace, for bilevel images and arrays, and for pages treated as bilevel
       gray: the grayscale image of the original page
-      eroded: the eroded grayscale image
-      binary: the binarzied image
+      eroded: the eroded grayscale image, at detection scale, the same array as binary for pages treated as bilevel
+      binary: the binarzied image, at detection scale
+      detection: (contours, hierarchy, level), all the contours found on the page before filtering (not refined below detect_scale 1), and the threshold level, see detect_contours
+      bilevel: bool, whether the page was treated as bilevel
       output:
         {dict}:
-          [bones]: image files as a list of numpy arrays
+          [bones]: image files as a list of numpy arrays (BitImage for a bilevel page)
           [boxes]: the bounding boxes of the bone tracings
-          [page]: the original image with bone tracings replaced by white background
+          [page]: the original image with bone tracings replaced by white background (BitImage for a bilevel page)
     """
 
-    def __init__(self, img_input, threshold=(200, 150), mode="poly", padding="white"):
+    def __init__(
+        self,
+        img_input,
+        threshold=(200, 150),
+        mode="poly",
+        padding="white",
+        detection=None,
+        detect_scale=1,
+        metrics=None,
+        inplace=False,
+        bilevel=False,
+        detect_only=False,
+        color=None,
+    ):
         self.mode = mode
-        # read image into grayscale ndarray
-        if type(img_input) == str:
-            try:
-                self.original = np.array(Image.open(img_input))
-                image = np.array(Image.open(img_input).convert("L"))
-            except FileNotFoundError:
-                raise FileNotFoundError(
-                    "Image file not found, make sure the path to the image is correct"
-                )
-        elif type(img_input) == Image.Image:
-            self.original = np.array(img_input)
-            image = np.array(img_input.convert("L"))
-        elif type(img_input) == np.ndarray:
-            self.original = img_input
-            image = img_input
-        else:
-            raise ValueError(
-                "Invalid input image type, must be a path string, PIL Image, or numpy array"
-            )
-        self.gray = image
-        # erode by a large kernel to merge smaller bounding boxes to cut computation, and to distinguish the tracing outlines
-        self.eroded = cv.erode(self.gray, np.ones((21, 21), np.uint8), iterations=1)
-        # a simple thresholding will do， as the image quality is quite good, otherwise, consider Canny instead
-        self.binary = cv.threshold(
-            self.eroded, 127, 255, cv.THRESH_BINARY + cv.THRESH_OTSU
-        )[1]
-        contours, hierarchy = cv.findContours(
-            self.binary, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
+        stages = PageDetection(
+            img_input, detect_scale, detection, metrics, inplace, bilevel, color
         )
-        """
-          Following code get only the first level bone contours, and filter out the number texts. This are several considerations:
-            1. parent-child relationship in the hierarchy, only first level should be found, thus filtering out all oracle bone characters
-            2. contour width and height. Use a (width, height) threshold to tell between the bone tracings and the number texts. The condition should be "and" or "or". The "or" might work better.Though the title text must be filtered out. This can be done by examining height/width ratio.
-            3. Width/Height ratio, should not exceed 5 to filter out the title text and others. Could consider crop the title text before processing if needed.
-            4. (Optional, not implemented) Extent ratio of the contour area to the bounding rectangle area. Normally the width and height will suffice, but it might be hard to find the correct value and some bones might be very small. So, in that case, can consider use shape descriptors, as Text, being more block-like and rectangle-like, might have a higher extent ratio compared to irregular bone tracings.
-        """
-        # can also consider use NMS suppression algorithm to merge adjancent boxes, it might not be necessary in our case as text boxes are merged by erosion and bone tracings are singular
-
-        # also make distinction between RGB and Gray images, where first-level contours have different parent index behavior
-        if len(self.original.shape) == 3:
-            valid_contours = [
-                cnt
-                for i, cnt in enumerate(contours)
-                if hierarchy[0][i][3] == 0
-                and (
-                    cv.boundingRect(cnt)[2] > threshold[0]
-                    or cv.boundingRect(cnt)[3] > threshold[1]
-                )
-                and cv.boundingRect(cnt)[2] / cv.boundingRect(cnt)[3] < 5
-            ]
-            if len(valid_contours) == 0:
-                valid_contours = [
-                    cnt
-                    for i, cnt in enumerate(contours)
-                    if hierarchy[0][i][3] == -1
-                    and (
-                        cv.boundingRect(cnt)[2] > threshold[0]
-                        or cv.boundingRect(cnt)[3] > threshold[1]
-                    )
-                    and cv.boundingRect(cnt)[2] / cv.boundingRect(cnt)[3] < 5
-                ]
+        self.original, self.gray = stages.original, stages.gray
+        self.eroded, self.binary = stages.eroded, stages.binary
+        self.detection = (stages.contours, stages.hierarchy, stages.level)
+        selection = stages.select(threshold)
+        self.contours = selection.contours  # for debugging
+        if metrics is not None:
+            metrics.count("objects", len(selection))
+        if detect_only:
+            self.output = {"images": [], "page": None, "boxes": selection.boxes}
         else:
-            valid_contours = [
-                cnt
-                for i, cnt in enumerate(contours)
-                if hierarchy[0][i][3] == 0
-                and (
-                    cv.boundingRect(cnt)[2] > threshold[0]
-                    or cv.boundingRect(cnt)[3] > threshold[1]
-                )
-                and cv.boundingRect(cnt)[2] / cv.boundingRect(cnt)[3] < 5
-            ]
-        # merge the child boxes manually in case the tracing outline is not closed
-        valid_contours = self.merge_nested_contours(valid_contours)
-        self.contours = valid_contours  # for debugging
-        output = {}
-        imgs = []
-        # crop the bone tracings by their polygon outline rather than rectangles
-        for i, cnt in enumerate(valid_contours):
-            # this is done by cropping image by binary masks
-            mask = np.full_like(
-                self.gray, 255
-            )  # use full_like rather than zeros_like to create white background
-            if self.mode == "poly":
-                cv.drawContours(mask, [cnt], -1, 0, -1)
-            else:
-                x, y, w, h = cv.boundingRect(cnt)
-                cv.rectangle(mask, (x, y), (x + w, y + h), 0, -1)
-            # Find the bounding rectangle of the contour
-            x, y, w, h = cv.boundingRect(cnt)
-            # give an extra 15% space around the new images, can add more if needed
-            cropped = convert_alpha(self.original, cnt)
-            cropped = cropped[y : y + h, x : x + w]
-            if padding == "transparent":
-                padding_value = (255, 255, 255, 0)
-            elif padding == "black":
-                padding_value = (0, 0, 0, 255)
-            else:
-                padding_value = (255, 255, 255, 255)
-            cropped = cv.copyMakeBorder(
-                cropped,
-                int(h * 0.15),
-                int(h * 0.15),
-                int(w * 0.15),
-                int(w * 0.15),
-                cv.BORDER_CONSTANT,
-                value=padding_value,
-            )
-            # detect original image's shape and save the cropped image as either Gray, RGB, or RGBA
-            # if is transparent
-            if padding == "transparent":
-                cropped = cropped
-            else:
-                # if is gray
-                if len(self.original.shape) == 2:
-                    cropped = cv.cvtColor(cropped, cv.COLOR_RGBA2GRAY)
-                # if is rgb
-                elif len(self.original.shape) == 3 and self.original.shape[2] == 3:
-                    cropped = cv.cvtColor(cropped, cv.COLOR_RGBA2RGB)
-                # if is rgba
-                elif len(self.original.shape) == 3 and self.original.shape[2] == 4:
-                    cropped = cropped
-            imgs.append(cropped)
-            # replace the original page image with white background where the bone tracings are
-            self.gray[mask == 0] = 255
-        output["images"] = imgs
-        output["page"] = self.gray
-        output["boxes"] = [cv.boundingRect(cnt) for cnt in valid_contours]
-        self.output = output
+            # the page is whitened in place, it is not extracted again
+            self.output = selection.extract(mode, padding, inplace=True)
+        self.original, self.bilevel = stages.original, stages.bilevel
 
     def merge_nested_contours(self, contours):
         """
-        This function is designed to merge nested boxes if any, this might happen when the bone tracings are not completely closed. I currently have no idea how to close the contour manually as some of the open contours are broken in the middle and will not close no matter what.
+        This function is designed to merge nested boxes if any, see the module level merge_nested_contours.
         """
-        boxes = [cv.boundingRect(cnt) for cnt in contours]
-        to_remove = []
-        for i, box in enumerate(boxes):
-            for j, other_box in enumerate(boxes):
-                if i != j:
-                    if (
-                        box[0] <= other_box[0]
-                        and box[1] <= other_box[1]
-                        and box[0] + box[2] >= other_box[0] + other_box[2]
-                        and box[1] + box[3] >= other_box[1] + other_box[3]
-                    ):
-                        to_remove.append(j)
-        merged = [cnt for i, cnt in enumerate(contours) if i not in to_remove]
-        return merged
+        return merge_nested_contours(contours)
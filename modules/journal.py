@@ -0,0 +1,93 @@
+import os
+import json
+
+
+def journal_name(shard=(1, 1)):
+    # one journal per shard, next to its manifest, see manifest_name
+    k, n = shard
+    return "progress.jsonl" if n == 1 else f"progress-{k}-of-{n}.jsonl"
+
+
+def partial_tag(shard=(1, 1)):
+    # tag of the temporary files of the image writers of a run (or of one shard of it), so that a resumed shard only removes its own, see ImageWriter
+    k, n = shard
+    return "part" if n == 1 else f"part-{k}-of-{n}"
+
+
+def remove_partial_files(save_path, shard=(1, 1), subfolders=("images", "pages", "overlays")):
+    """
+    description:
+      remove the temporary files left behind by writes of a previous run of this shard interrupted before their rename, named {file}.{tag}.{pid}.tmp, see ImageWriter. The files of the other shards writing into the same folder are left alone, as they may still be running
+    """
+    tag = partial_tag(shard)
+    for subfolder in subfolders:
+        folder = os.path.join(save_path, subfolder)
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if not entry.name.endswith(".tmp"):
+                    continue
+                head, _, pid = entry.name[: -len(".tmp")].rpartition(".")
+                if pid.isdigit() and head.endswith(f".{tag}"):
+                    os.remove(entry.path)
+
+
+class ProgressJournal:
+    """
+    description:
+      An append-only journal of the pages completed by a run, kept in the output folder. The first line describes the run (input and output options), then one json line is appended per page once all of its files are written, and flushed to disk, so that a run killed at any point can be resumed from the last completed page. A line torn by the crash is dropped on resume, and its page is redone.
+
+    args:
+      save_path: str, path to the output folder
+      header: dict, the input and options of the run, a resumed run must have the same
+      shard: tuple, (k, N), see parse_shard
+      resume: bool, continue the journal of a previous run, otherwise a new journal is started
+
+    attribute:
+      done: dict, page -> entry ({"page", "files"}), the pages completed by the previous run whose files all still exist
+    """
+
+    def __init__(self, save_path, header, shard=(1, 1), resume=False):
+        self.path = os.path.join(save_path, journal_name(shard))
+        self.done = {}
+        os.makedirs(save_path, exist_ok=True)
+        if resume and os.path.isfile(self.path):
+            self.done = self.read(header)
+            remove_partial_files(save_path, shard)
+            self.file = open(self.path, "a", encoding="utf-8")
+        else:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.append({"header": header})
+
+    def read(self, header):
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            # drop a last line torn by the crash, so that appended lines start on their own line
+            complete = data[: data.rfind(b"\n") + 1]
+            if len(complete) < len(data):
+                f.truncate(len(complete))
+        lines = complete.decode("utf-8").splitlines()
+        if not lines or json.loads(lines[0]).get("header") != header:
+            raise ValueError(
+                f"{self.path} was written by a run with another input or other options, resume with the same ones or start a new run"
+            )
+        save_path = os.path.dirname(self.path)
+        done = {}
+        for line in lines[1:]:
+            entry = json.loads(line)
+            if all(os.path.isfile(os.path.join(save_path, f)) for f in entry["files"]):
+                done[entry["page"]] = entry
+        return done
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def match_labels(boxes, centers):
+    """
+    description:
+      assign every bone its closest label, by the distance between the center of the text and the bottom center of the box (as the text is always at the exact bottom or near bottom).
+      A label is given to one bone at most, if several bones are closest to the same label, the closest (bone, label) pairs are handed out first and the others take their next closest free label, so that the result is deterministic.
+    args:
+      boxes: array like, (n, 4), the [x, y, w, h] boxes of the bones
+      centers: array like, (m, 2), the center points of the labels
+    returns:
+      numpy array, (n,), the index of the label of every bone, -1 if there are more bones than labels
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    assigned = np.full(len(boxes), -1)
+    if len(boxes) == 0 or len(centers) == 0:
+        return assigned
+    anchors = np.stack([boxes[:, 0] + boxes[:, 2] / 2, boxes[:, 1] + boxes[:, 3]], 1)
+    distances = np.linalg.norm(anchors[:, None, :] - centers[None, :, :], axis=2)
+    nearest = distances.argmin(axis=1)
+    if len(np.unique(nearest)) == len(nearest):
+        return nearest  # no conflicts, which is the common case
+    used = np.zeros(len(centers), dtype=bool)
+    remaining = min(len(boxes), len(centers))
+    for flat in np.argsort(distances, axis=None, kind="stable"):
+        bone, label = divmod(int(flat), len(centers))
+        if assigned[bone] == -1 and not used[label]:
+            assigned[bone] = label
+            used[label] = True
+            remaining -= 1
+            if remaining == 0:
+                break
+    return assigned
+
+
+def page_words(page, x_tolerance=8):
+    """
+    description:
+      the words of the text layer of a pdf page, with their centers in pdf points
+    args:
+      page: pdfplumber.Page, of the source pdf itself or of its ocr pdf
+      x_tolerance: int, for merging adjacent characters into a single number, set a higher value if some numbers are split
+    returns:
+      (texts, centers, size), list of str, numpy array (m, 2), and the (width, height) of the page in points
+    """
+    # number text, there might be useless text like "典宾"、"宾一" which does not matter
+    words = page.extract_words(x_tolerance=x_tolerance)
+    texts = [word["text"] for word in words]
+    centers = np.array(
+        [
+            ((word["x0"] + word["x1"]) / 2, (word["top"] + word["bottom"]) / 2)
+            for word in words
+        ],
+        dtype=float,
+    ).reshape(-1, 2)
+    return texts, centers, (float(page.width), float(page.height))
+
+
+def label_names(boxes, words, image_size):
+    """
+    description:
+      the number of every bone of a page, matched in memory against the words of the page, for naming the bone files right away instead of renaming them afterwards
+    args:
+      boxes: list, the [x, y, w, h] boxes of the bones in image pixels
+      words: tuple, see page_words
+      image_size: tuple, (width, height) of the page image in pixels, the words are scaled from points to it
+    returns:
+      list of str or None, one per box, None when there is no label left for the bone or its label is already taken by another bone of the page
+    """
+    texts, centers, (page_width, page_height) = words
+    # normalize the ratio discrepancy caused by DPI difference
+    ratio = (image_size[0] / page_width + image_size[1] / page_height) / 2
+    names, taken = [], set()
+    for label in match_labels(boxes, centers * ratio):
+        # a path separator in the ocr text would turn the name into a folder
+        name = None if label == -1 else texts[label].replace("/", "_").replace("\\", "_")
+        if name in taken:
+            name = None
+        names.append(name)
+        taken.add(name)
+    return names
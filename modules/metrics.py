@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+def peak_rss_mb():
+    """
+    description:
+      peak resident memory of the current process in MB (since the last reset_peak_rss on linux), None if it can not be measured on this platform
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / (1 << 10)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+
+            return psutil.Process().memory_info().peak_wset / (1 << 20)  # windows
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def reset_peak_rss():
+    """
+    description:
+      reset the peak resident memory of the current process to the current one, so that the peak of a single page can be measured. Only supported on linux, elsewhere the peak keeps growing over the whole run.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class PageMetrics:
+    """
+    description:
+      Collects the timings and counters of processing a single page, filled in by RubbingCropper and parse_pdf when passed along
+
+    args:
+      page: int or str, the page number or image name the metrics belong to
+
+    attribute:
+      timings: dict, stage name -> seconds, repeated stages (e.g. crop, once per object) are summed
+      counters: dict, counter name -> value, e.g. contours found before and after filtering, bytes written
+    """
+
+    def __init__(self, page=None):
+        self.page = page
+        self.timings = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+        reset_peak_rss()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[stage] = self.timings.get(stage, 0) + elapsed
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self):
+        return {
+            "page": self.page,
+            "pid": os.getpid(),
+            "seconds": time.perf_counter() - self.start,
+            "timings": self.timings,
+            "counters": self.counters,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def timed(metrics, stage):
+    # time a stage into metrics, or do nothing if no metrics are collected
+    return metrics.time(stage) if metrics is not None else nullcontext()
+
+
+class MetricsSink:
+    """
+    description:
+      Where the per page metrics records go, appended as one json line per page to a file, and/or passed to a callback, e.g. to ship them into a metrics system
+
+    args:
+      path: str, optional path of the jsonl file, appended to
+      callback: callable, optional, called with every record (a dict, see PageMetrics.to_dict)
+    """
+
+    def __init__(self, path=None, callback=None):
+        self.file = open(path, "a", encoding="utf-8") if path is not None else None
+        self.callback = callback
+
+    def __call__(self, record):
+        if record is None:
+            return
+        if self.file is not None:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+        if self.callback is not None:
+            self.callback(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
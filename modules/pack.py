@@ -0,0 +1,237 @@
+import io
+import os
+import glob
+import json
+import time
+import uuid
+import tarfile
+import zipfile
+import threading
+
+# container formats of the packed output, crops are stored uncompressed in them as they are compressed images already
+PACK_FORMATS = {"tar": ".tar", "zip": ".zip"}
+
+
+def index_name(shard=(1, 1)):
+    # one index per shard, next to its manifest, see manifest_name
+    k, n = shard
+    return "index.jsonl" if n == 1 else f"index-{k}-of-{n}.jsonl"
+
+
+def pack_prefix(shard=(1, 1)):
+    # prefix of the container and partial index files of the pack writers of a run (or of one shard of it)
+    k, n = shard
+    return "pack" if n == 1 else f"pack-{k}-of-{n}"
+
+
+def read_index(path):
+    """
+    description:
+      the rows of an index (or of the partial index of a writer), a last line torn by a crash is dropped
+    returns:
+      list of dict, see PackWriter.add
+    """
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.endswith("\n"):
+                rows.append(json.loads(line))
+    return rows
+
+
+def write_index(path, rows):
+    # write to a temporary file and rename, as write_json does for manifests
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def sort_rows(rows):
+    # page order, then the order of the objects on their page, whatever order they were written in
+    return sorted(rows, key=lambda row: (row["page"], row["object"]))
+
+
+def build_index(save_path, entries, shard=(1, 1)):
+    """
+    description:
+      consolidate the partial indexes of the pack writers of a run (one per process) into the index of the run, and remove them. Only the rows of the completed pages whose container is listed in the manifest entry of their page are kept, so that the rows of pages interrupted by a crash and redone on resume are dropped. The index of a previous run into save_path (when resumed) is consolidated as well
+    args:
+      save_path: str, path to the output folder
+      entries: list of dict, the manifest entries of the run, see Manifest
+      shard: tuple, (k, N), see parse_shard
+    returns:
+      list of dict, the rows of the index, in page order
+    """
+    files = {entry["page"]: set(entry["files"]) for entry in entries}
+    path = os.path.join(save_path, index_name(shard))
+    parts = sorted(glob.glob(os.path.join(save_path, f"{pack_prefix(shard)}-{'?' * 8}.jsonl")))
+    rows = {}
+    for part in ([path] if os.path.isfile(path) else []) + parts:
+        for row in read_index(part):
+            if row["file"] in files.get(row["page"], ()):
+                rows[row["file"], row["name"]] = row
+    rows = sort_rows(rows.values())
+    write_index(path, rows)
+    for part in parts:
+        os.remove(part)
+    return rows
+
+
+class PackWriter:
+    """
+    description:
+      A writer of encoded images into containers of bounded size instead of one file per image, with an index of every image. Containers are named {prefix}-{token}-{number}.tar (or .zip) after a random token of the writer, so that the writers of several processes, shards and resumed runs never write into the same file. Every image is appended to the current container and flushed, and its index row is appended to the partial index {prefix}-{token}.jsonl of the writer, see build_index. Tar containers stay readable when the run is interrupted, zip ones need close to write their central directory, the index works with both as it records the byte offsets of the data.
+
+    args:
+      save_path: str, path to the output folder
+      fmt: str, "tar" or "zip"
+      max_bytes: int, size at which a new container is started, a container holds at least one image
+      prefix: str, see pack_prefix
+
+    attribute:
+      files: list of str, the containers written, relative to save_path
+    """
+
+    def __init__(self, save_path, fmt="tar", max_bytes=1 << 30, prefix="pack"):
+        if fmt not in PACK_FORMATS:
+            raise ValueError(f"Invalid pack format {fmt}, must be one of {list(PACK_FORMATS)}")
+        self.save_path = save_path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.name = f"{prefix}-{uuid.uuid4().hex[:8]}"
+        self.files = []
+        self.file, self.container = None, None
+        self.lock = threading.Lock()
+        os.makedirs(save_path, exist_ok=True)
+        self.index = open(os.path.join(save_path, f"{self.name}.jsonl"), "a", encoding="utf-8")
+
+    def next_container(self):
+        self.close_container()
+        file = f"{self.name}-{len(self.files):05d}{PACK_FORMATS[self.fmt]}"
+        self.file = open(os.path.join(self.save_path, file), "wb")
+        if self.fmt == "tar":
+            self.container = tarfile.open(fileobj=self.file, mode="w", format=tarfile.PAX_FORMAT)
+        else:
+            self.container = zipfile.ZipFile(self.file, "w", zipfile.ZIP_STORED)
+        self.files.append(file)
+
+    def close_container(self):
+        if self.container is not None:
+            self.container.close()  # end of archive blocks or central directory
+            self.file.close()
+            self.file, self.container = None, None
+
+    def add(self, name, data, meta=None):
+        """
+        description:
+          append an encoded image to the current container, starting a new one if it would grow beyond max_bytes
+        args:
+          name: str, the member name of the image, e.g. "1-[10, 20, 300, 400].png"
+          data: bytes, the encoded image
+          meta: dict, what is known of the image, e.g. {"page", "object", "box", "polygon", "dpi"}, stored in its index row
+        returns:
+          str, the container the image went into, relative to save_path
+        """
+        with self.lock:
+            if self.container is None or (
+                self.file.tell() > 0 and self.file.tell() + len(data) > self.max_bytes
+            ):
+                self.next_container()
+            if self.fmt == "tar":
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime = len(data), int(time.time())
+                self.container.addfile(info, io.BytesIO(data))
+                # the data is followed by its padding to the 512 bytes blocks of tar
+                offset = self.file.tell() - (len(data) + 511) // 512 * 512
+            else:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                self.container.writestr(info, data)
+                offset = self.file.tell() - len(data)
+            self.file.flush()
+            row = dict(meta or {}, name=name, file=self.files[-1], offset=offset, size=len(data))
+            self.index.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.index.flush()
+            return self.files[-1]
+
+    def close(self):
+        with self.lock:
+            self.close_container()
+            self.index.close()
+
+
+class PackReader:
+    """
+    description:
+      Random access to the images of a packed output by their index, an image is read from its container by its byte offset, without unpacking or scanning the container
+
+    args:
+      path: str, an output folder, whose index.jsonl (or the indexes of its shards, if they were not merged) is read, or the path of an index file
+
+    attribute:
+      rows: list of dict, the index rows, {"page", "object", "name", "file", "offset", "size", "box", "polygon", "dpi"}, in page order
+    """
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            paths = [os.path.join(path, index_name())]
+            if not os.path.isfile(paths[0]):
+                paths = sorted(glob.glob(os.path.join(path, "index-*-of-*.jsonl")))
+            if not paths:
+                raise ValueError(f"No index found in {path}")
+        else:
+            paths = [path]
+        self.folder = os.path.dirname(os.path.abspath(paths[0]))
+        self.rows = sort_rows([row for p in paths for row in read_index(p)])
+        self.handles = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def find(self, page=None, name=None):
+        # the rows of a page and/or of a member name
+        return [
+            row
+            for row in self.rows
+            if (page is None or row["page"] == page) and (name is None or row["name"] == name)
+        ]
+
+    def read(self, row):
+        """
+        description:
+          the encoded bytes of an image
+        args:
+          row: int or dict, the position of the image in rows, or its index row
+        returns:
+          bytes, e.g. the content of a png file
+        """
+        if isinstance(row, int):
+            row = self.rows[row]
+        f = self.handles.get(row["file"])
+        if f is None:
+            f = self.handles[row["file"]] = open(os.path.join(self.folder, row["file"]), "rb")
+        f.seek(row["offset"])
+        return f.read(row["size"])
+
+    def image(self, row):
+        # the image decoded with PIL, see read
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(self.read(row)))
+        image.load()
+        return image
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,77 @@
+import cv2 as cv
+import numpy as np
+from PIL import Image, ImageDraw
+
+# tolerance of the simplified polygons, as a fraction of the perimeter of the object
+POLYGON_EPSILON = 0.005
+# colours of the boxes and of the polygons on the overlays
+BOX_COLOR = (0, 90, 255)
+POLYGON_COLOR = (255, 40, 0)
+
+
+def simplify_polygon(cnt, epsilon=POLYGON_EPSILON):
+    """
+    description:
+      the outline of an object simplified by Douglas-Peucker, a few dozen points instead of thousands, for previewing and storing the detection
+    returns:
+      list of [x, y], in page pixels
+    """
+    approx = cv.approxPolyDP(cnt, epsilon * cv.arcLength(cnt, True), True)
+    return approx.reshape(-1, 2).tolist()
+
+
+def detection_record(contours, image_size, dpi=None, labels=None, n_contours=None):
+    """
+    description:
+      the detection of a page as a json serialisable dict, see parse_pdf with detect_only
+    args:
+      contours: list, the object contours, see RubbingCropper or TiledCropper
+      image_size: tuple, (width, height) of the page image in pixels
+      dpi: int, optional resolution of the page image
+      labels: list, optional number of every object, see label_names
+      n_contours: int, optional number of contours found before filtering, for tuning text_threshold
+    returns:
+      dict, {"size", "dpi", "contours", "boxes", "polygons", "labels"}, the optional fields only when given
+    """
+    record = {"size": [int(image_size[0]), int(image_size[1])]}
+    if dpi is not None:
+        record["dpi"] = dpi
+    if n_contours is not None:
+        record["contours"] = n_contours
+    record["boxes"] = [[int(v) for v in cv.boundingRect(cnt)] for cnt in contours]
+    record["polygons"] = [simplify_polygon(cnt) for cnt in contours]
+    if labels is not None:
+        record["labels"] = labels
+    return record
+
+
+def draw_overlay(page, boxes, polygons, size=1024):
+    """
+    description:
+      a downscaled thumbnail of the page with the boxes and polygons of the objects drawn over it, to check the detection at a glance
+    args:
+      page: numpy array or PIL Image, the page the objects were detected on (gray, RGB or RGBA)
+      boxes: list, the [x, y, w, h] boxes in page pixels
+      polygons: list, the [[x, y], ...] polygons in page pixels
+      size: int, the longest side of the thumbnail in pixels
+    returns:
+      PIL Image, RGB
+    """
+    image = page if isinstance(page, Image.Image) else Image.fromarray(np.asarray(page))
+    scale = min(1.0, size / max(image.size))
+    thumb_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    # reduced by an integer factor first, which is cheap on large pages
+    thumb = image.resize(thumb_size, Image.Resampling.BOX, reducing_gap=2.0).convert("RGB")
+    draw = ImageDraw.Draw(thumb)
+    width = max(1, round(max(thumb_size) / 400))
+    for x, y, w, h in boxes:
+        draw.rectangle(
+            [x * scale, y * scale, (x + w) * scale, (y + h) * scale],
+            outline=BOX_COLOR,
+            width=width,
+        )
+    for polygon in polygons:
+        if len(polygon) > 1:
+            points = [(x * scale, y * scale) for x, y in polygon]
+            draw.line(points + points[:1], fill=POLYGON_COLOR, width=width)
+    return thumb
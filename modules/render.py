@@ -0,0 +1,162 @@
+import io
+import struct
+import numpy as np
+from PIL import Image
+from pdfminer.layout import LTFigure, LTImage
+
+BACKENDS = ("raster", "embedded")
+# resolution of the thumbnails comparing an embedded image mask with the rendered page, see embedded_image
+VERIFY_DPI = 18
+# largest mean difference (0-255) between the two thumbnails for the image mask to be used
+VERIFY_TOLERANCE = 12
+
+
+def ccitt_tiff(data, width, height, params):
+    """
+    description:
+      wrap a CCITTFaxDecode stream into a single strip tiff, so that it can be decoded by PIL (libtiff) without going through the renderer
+    returns:
+      bytes of the tiff file, or None for the variants not supported (mixed 1D/2D group 3 and byte aligned rows)
+    """
+    k = params.get("K", 0)
+    if k > 0 or params.get("EncodedByteAlign", False):
+        return None
+    compression = 4 if k < 0 else 3  # group 4, or group 3 1D
+    # pdf default is black for 0 bits, which is WhiteIsZero = 0 in tiff terms inverted
+    photometric = 1 if params.get("BlackIs1", False) else 0
+    tags = [
+        (256, 4, width),  # ImageWidth
+        (257, 4, height),  # ImageLength
+        (258, 3, 1),  # BitsPerSample
+        (259, 3, compression),
+        (262, 3, photometric),
+        (273, 4, 0),  # StripOffsets, filled below
+        (277, 3, 1),  # SamplesPerPixel
+        (278, 4, height),  # RowsPerStrip
+        (279, 4, len(data)),  # StripByteCounts
+    ]
+    header_size = 8 + 2 + 12 * len(tags) + 4
+    ifd = struct.pack("<H", len(tags))
+    for tag, kind, value in tags:
+        value = header_size if tag == 273 else value
+        if kind == 3:
+            ifd += struct.pack("<HHIHH", tag, kind, 1, value, 0)
+        else:
+            ifd += struct.pack("<HHII", tag, kind, 1, value)
+    return b"II*\x00" + struct.pack("<I", 8) + ifd + struct.pack("<I", 0) + data
+
+
+def decode_stream(stream):
+    """
+    description:
+      decode an image xobject at its native resolution, the compressed formats of scans are decoded from the raw stream, raw samples from the filtered data
+    returns:
+      PIL Image, or None if the encoding is not supported here (e.g. JBIG2, soft masks, indexed colours)
+    """
+    attrs = stream.attrs
+    filters = attrs.get("Filter")
+    filters = filters if isinstance(filters, list) else [filters]
+    filters = [getattr(f, "name", f) for f in filters if f is not None]
+    params = attrs.get("DecodeParms") or {}
+    params = params[-1] if isinstance(params, list) else params
+    width, height = attrs.get("Width"), attrs.get("Height")
+    if attrs.get("SMask") is not None or attrs.get("Decode") is not None:
+        return None
+    if filters == ["CCITTFaxDecode"]:
+        tiff = ccitt_tiff(stream.get_rawdata(), width, height, params)
+        return Image.open(io.BytesIO(tiff)) if tiff is not None else None
+    if filters in (["DCTDecode"], ["JPXDecode"]):
+        return Image.open(io.BytesIO(stream.get_rawdata()))
+    if filters in ([], ["FlateDecode"], ["LZWDecode"]):
+        colorspace = getattr(attrs.get("ColorSpace"), "name", None)
+        bits = attrs.get("BitsPerComponent", 1 if attrs.get("ImageMask") else 8)
+        mode = {
+            (1, None): "1",
+            (1, "DeviceGray"): "1",
+            (8, "DeviceGray"): "L",
+            (8, "DeviceRGB"): "RGB",
+        }.get((bits, colorspace))
+        if mode is None:
+            return None
+        return Image.frombytes(mode, (width, height), stream.get_data())
+    return None
+
+
+def image_matrix(layout, name):
+    # the transformation placing the image xobject of this name on the page, from the figure pdfminer wraps it into
+    for obj in layout:
+        if isinstance(obj, LTFigure):
+            if any(isinstance(c, LTImage) and c.name == name for c in obj):
+                return obj.matrix
+            matrix = image_matrix(obj, name)
+            if matrix is not None:
+                return matrix
+    return None
+
+
+def embedded_image(page, verify_masks=True):
+    """
+    description:
+      the scan of a page made of a single upright image covering it, decoded at its native resolution
+    args:
+      page: pdfplumber.Page
+      verify_masks: bool, image masks are painted in the fill colour, which is not known here, so they are compared with a thumbnail rendered by pdfplumber, cheap as masks are bilevel
+    returns:
+      PIL Image, in mode "1" or "L" for bilevel and gray scans, which are never expanded to RGB (a CCITT fax page would take 24 times the memory), RGB otherwise, or None if the page is not a single image scan or the image can not be decoded
+    """
+    if len(page.images) != 1 or page.rotation % 360 != 0:
+        return None
+    image = page.images[0]
+    x0, top, x1, bottom = page.bbox
+    tolerance = 0.01 * max(page.width, page.height)
+    if (
+        abs(image["x0"] - x0) > tolerance
+        or abs(image["top"] - top) > tolerance
+        or abs(image["x1"] - x1) > tolerance
+        or abs(image["bottom"] - bottom) > tolerance
+    ):
+        return None
+    # neither rotated nor flipped, rows run from the top of the page down
+    matrix = image_matrix(page.layout, image["name"])
+    if matrix is None or matrix[1] or matrix[2] or matrix[0] <= 0 or matrix[3] <= 0:
+        return None
+    try:
+        img = decode_stream(image["stream"])
+        # cmyk jpegs are often stored inverted, leave them to the renderer
+        if img is None or img.mode not in ("1", "L", "RGB"):
+            return None
+        img.load()  # decodes the lazily opened formats
+    except Exception:
+        return None  # any decoding problem, the renderer knows better
+    if img.size != tuple(image["srcsize"]):
+        return None
+    if verify_masks and image["imagemask"]:
+        thumb = page.to_image(resolution=VERIFY_DPI).original.convert("L")
+        small = img.convert("L").resize(thumb.size, Image.BOX)
+        difference = np.abs(
+            np.asarray(thumb, dtype=np.int16) - np.asarray(small, dtype=np.int16)
+        )
+        if difference.mean() > VERIFY_TOLERANCE:
+            return None
+    return img
+
+
+def render_page(page, dpi=600, backend="raster"):
+    """
+    description:
+      the image of a pdf page, rasterised by pdfplumber, or with the embedded backend, the scan embedded in the page at its native resolution, falling back to rasterisation for other pages
+    args:
+      page: pdfplumber.Page
+      dpi: int, resolution of the rasterisation
+      backend: str, "raster" or "embedded"
+    returns:
+      (PIL Image, dpi, embedded), the image, its actual resolution, which is the scan resolution for embedded images, and whether the embedded image was used. Rendered pages are RGB, embedded images keep their mode, see embedded_image
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid backend {backend}, must be one of {BACKENDS}")
+    if backend == "embedded":
+        img = embedded_image(page)
+        if img is not None:
+            return img, round(img.width * 72 / float(page.width)), True
+    # abbyy finereader image conversion use a 600dpi, consider chaning this if needed
+    return page.to_image(resolution=dpi, antialias=True).original, dpi, False
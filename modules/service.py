@@ -0,0 +1,247 @@
+import json
+import time
+import uuid
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# states of a job, in the order they go through
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+class JobService:
+    """
+    description:
+      A queue of jobs run on a pool of long-lived worker processes, so that every job finds the imports (and anything else set up by the initializer) of its worker already warm. Jobs are plain dicts, run by a top-level function in a worker, and their status can be queried by id while they are queued, running and once finished.
+
+    args:
+      run: callable, top-level (picklable) function called in a worker with the job dict, its return value (json serialisable) is the result of the job
+      validate: callable, optional, called with the job dict when it is submitted, raising ValueError rejects the job, and returning a dict replaces the job
+      workers: int, number of worker processes, i.e. of jobs running at the same time
+      initializer: callable, optional top-level function run once by every worker process when it starts, e.g. importing the heavy modules
+      history: int, number of finished jobs whose status is kept, the oldest are forgotten beyond it
+
+    attribute:
+      jobs: OrderedDict, job id -> status dict (id, job, status, submitted, started, finished, seconds, result, error), in submission order
+    """
+
+    def __init__(self, run, validate=None, workers=2, initializer=None, history=1000):
+        self.run = run
+        self.validate = validate
+        self.history = history
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.initializer = initializer
+        self.processes = ProcessPoolExecutor(workers, initializer=initializer)
+        # one dispatching thread per worker process, so that a job is marked running exactly when a worker takes it
+        self.dispatchers = ThreadPoolExecutor(workers)
+        self.workers = workers
+
+    def submit(self, job):
+        """
+        description:
+          validate a job and queue it
+        returns:
+          dict, the status of the job, with its id
+        """
+        if self.validate is not None:
+            job = self.validate(job) or job
+        job_id = uuid.uuid4().hex[:16]
+        status = {
+            "id": job_id,
+            "job": job,
+            "status": "queued",
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "seconds": None,
+            "result": None,
+            "error": None,
+        }
+        with self.lock:
+            self.jobs[job_id] = status
+            self.forget()
+            snapshot = dict(status)
+        self.dispatchers.submit(self.dispatch, job_id)
+        return snapshot
+
+    def dispatch(self, job_id):
+        with self.lock:
+            status = self.jobs[job_id]
+            status["status"], status["started"] = "running", time.time()
+            job = status["job"]
+        processes = self.processes
+        try:
+            result, error = processes.submit(self.run, job).result(), None
+        except BrokenProcessPool as e:
+            # a worker died (e.g. killed by the system for its memory), the pool is replaced for the next jobs
+            result, error = None, f"{type(e).__name__}: {e}"
+            with self.lock:
+                if self.processes is processes:
+                    self.processes = ProcessPoolExecutor(
+                        self.workers, initializer=self.initializer
+                    )
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        with self.lock:
+            status["status"] = "done" if error is None else "failed"
+            status["finished"] = time.time()
+            status["seconds"] = status["finished"] - status["started"]
+            status["result"], status["error"] = result, error
+
+    def forget(self):
+        # drop the oldest finished jobs beyond the history, queued and running jobs are always kept
+        finished = [i for i, s in self.jobs.items() if s["status"] in ("done", "failed")]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id=None):
+        """
+        description:
+          the status of a job, or of all the known jobs when job_id is None
+        returns:
+          dict, or list of dict in submission order, None for an unknown job id
+        """
+        with self.lock:
+            if job_id is None:
+                return [dict(s) for s in self.jobs.values()]
+            status = self.jobs.get(job_id)
+            return dict(status) if status is not None else None
+
+    def health(self):
+        with self.lock:
+            counts = {state: 0 for state in JOB_STATES}
+            for status in self.jobs.values():
+                counts[status["status"]] += 1
+        return {"status": "ok", "workers": self.workers, "jobs": counts}
+
+    def close(self, wait=True):
+        # queued jobs are cancelled, running ones are waited for if wait is set
+        self.dispatchers.shutdown(wait=wait, cancel_futures=True)
+        self.processes.shutdown(wait=wait, cancel_futures=True)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    description:
+      The json over HTTP interface of a JobService:
+        POST /jobs, body {"kind": ..., "args": {...}}: queue a job, 202 with its status, 400 if it is invalid
+        GET /jobs/<id>: status of a job, 404 if unknown
+        GET /jobs: status of all the known jobs
+        GET /health: number of workers and of jobs in every state
+    """
+
+    service = None  # set by make_server
+    quiet = False
+
+    def send_json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/health":
+            self.send_json(200, self.service.health())
+        elif path == "/jobs":
+            self.send_json(200, self.service.status())
+        elif path.startswith("/jobs/"):
+            status = self.service.status(path[len("/jobs/") :])
+            if status is None:
+                self.send_json(404, {"error": f"Unknown job {path[len('/jobs/') :]}"})
+            else:
+                self.send_json(200, status)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length) or b"null")
+            if not isinstance(job, dict):
+                raise ValueError("The job must be a json object")
+            self.send_json(202, self.service.submit(job))
+        except ValueError as e:  # json errors included
+            self.send_json(400, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(service, host="127.0.0.1", port=8765, quiet=False):
+    """
+    description:
+      an HTTP server exposing the service, see JobRequestHandler, each request is handled on its own thread. Run it with serve_forever()
+    args:
+      host: str, address to listen on, the local machine only by default, there is no authentication
+      port: int, 0 picks a free port, see server.server_address
+      quiet: bool, do not log every request to stderr
+    """
+    handler = type("Handler", (JobRequestHandler,), {"service": service, "quiet": quiet})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def request_json(url, data=None, timeout=30):
+    # a GET, or a POST of data as json, returning the decoded json answer, the error message of the service is raised as ValueError
+    body = None if data is None else json.dumps(data).encode("utf-8")
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get("error", e.reason)
+        except ValueError:
+            message = e.reason
+        raise ValueError(f"{e.code}: {message}") from None
+
+
+def submit_job(url, job):
+    """
+    description:
+      queue a job on a running service
+    args:
+      url: str, base url of the service, e.g. http://127.0.0.1:8765
+      job: dict, e.g. {"kind": "crop", "args": {"src_path": ..., "dst_path": ...}}
+    returns:
+      dict, the status of the job, with its id
+    """
+    return request_json(f"{url.rstrip('/')}/jobs", job)
+
+
+def get_job(url, job_id):
+    # the current status of a job
+    return request_json(f"{url.rstrip('/')}/jobs/{job_id}")
+
+
+def wait_job(url, job_id, interval=0.1, timeout=None):
+    """
+    description:
+      poll the status of a job until it is done or failed
+    args:
+      interval: float, seconds between two polls
+      timeout: float, optional, seconds after which TimeoutError is raised
+    returns:
+      dict, the final status of the job
+    """
+    start = time.monotonic()
+    while True:
+        status = get_job(url, job_id)
+        if status["status"] in ("done", "failed"):
+            return status
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError(f"Job {job_id} is still {status['status']} after {timeout}s")
+        time.sleep(interval)
@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import glob
+import shutil
+import hashlib
+
+from .pack import index_name, read_index, sort_rows, write_index
+
+
+def parse_page_list(spec, n_pages):
+    """
+    description:
+      parse a page selection like "1-40,55,90-" into the sorted page numbers it covers, an open end runs to the last page, an open start from the first one
+    args:
+      spec: str, comma separated page numbers and inclusive ranges, 1-based
+      n_pages: int, the number of pages of the pdf, pages beyond it are dropped
+    returns:
+      list of int, sorted and without duplicates
+    """
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d*)\s*-\s*(\d*)|(\d+)", part)
+        if match is None or part == "-":
+            raise ValueError(f"Invalid page selection {part!r} in {spec!r}")
+        if match.group(3) is not None:
+            first = last = int(match.group(3))
+        else:
+            first = int(match.group(1)) if match.group(1) else 1
+            last = int(match.group(2)) if match.group(2) else n_pages
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid page range {part!r} in {spec!r}")
+        pages.update(range(first, min(last, n_pages) + 1))
+    return sorted(pages)
+
+
+def parse_shard(spec):
+    """
+    description:
+      parse a "k/N" shard option, the k-th of N shards, 1-based
+    returns:
+      (k, N)
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", spec)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard {spec!r}, expected k/N with 1 <= k <= N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_items(items, shard=(1, 1)):
+    """
+    description:
+      the items (page numbers or file paths, in a deterministic order) assigned to a shard. Items are dealt round robin, so that every shard gets a similar mix of pages even when the heavy pages are clustered
+    args:
+      items: list, sorted page numbers or sorted file paths
+      shard: tuple, (k, N), see parse_shard
+    """
+    k, n = shard
+    return items[k - 1 :: n]
+
+
+def manifest_name(shard=(1, 1)):
+    # a single run writes manifest.json, every shard its own one, so that shards can share an output folder
+    k, n = shard
+    return "manifest.json" if n == 1 else f"manifest-{k}-of-{n}.json"
+
+
+def detection_name(shard=(1, 1)):
+    # the detections of a detect_only run, one file per shard as well
+    k, n = shard
+    return "detections.jsonl" if n == 1 else f"detections-{k}-of-{n}.jsonl"
+
+
+def list_hash(names):
+    # identifies a folder input by its sorted file names, the same on every node
+    return hashlib.sha256("\n".join(names).encode("utf-8")).hexdigest()[:32]
+
+
+def write_json(path, data):
+    # write to a temporary file and rename, so that a manifest is never seen half written
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+class Manifest:
+    """
+    description:
+      The record of what a run (or one shard of it) has written, one entry per page or image with the files written for it, saved as json into the output folder
+
+    args:
+      save_path: str, path to the output folder
+      source: str, name of the pdf or folder
+      source_hash: str, content hash of the pdf, or hash of the file names of a folder, so that shards of different inputs are never merged
+      shard: tuple, (k, N), see parse_shard
+      options: dict, the parameters changing the output, which must be the same for all the shards
+    """
+
+    def __init__(self, save_path, source, source_hash, shard=(1, 1), options=None):
+        self.path = os.path.join(save_path, manifest_name(shard))
+        self.data = {
+            "source": source,
+            "source_hash": source_hash,
+            "shard": list(shard),
+            "options": options or {},
+            "entries": [],
+        }
+
+    def header(self):
+        # the description of the run, without its entries, see ProgressJournal
+        return {k: v for k, v in self.data.items() if k != "entries"}
+
+    def add(self, entry):
+        # entry: dict, {"page": page number or image name, "files": paths relative to the output folder}
+        self.data["entries"].append(entry)
+
+    def write(self):
+        # in page order, whatever order the pages were completed in, e.g. when resumed
+        self.data["entries"].sort(key=lambda entry: entry["page"])
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        write_json(self.path, self.data)
+
+
+def find_manifests(paths):
+    # the shard manifests given directly or found in the given output folders
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, "manifest-*-of-*.json"))))
+        else:
+            found.append(path)
+    return found
+
+
+def merge_manifests(paths, save_path):
+    """
+    description:
+      combine the shards of a run into a single output folder. The shards are checked to come from the same input with the same options and to be complete, the files of shards written elsewhere (e.g. on other nodes) are copied over, and a single manifest.json listing every page in order is written, with a single index.jsonl for a packed output, and a single detections.jsonl for a detect_only run
+    args:
+      paths: list of str, shard manifests or output folders containing them
+      save_path: str, path to the merged output folder
+    returns:
+      dict, the merged manifest
+    """
+    manifests = []
+    for path in find_manifests(paths):
+        with open(path, encoding="utf-8") as f:
+            manifests.append((os.path.dirname(os.path.abspath(path)), json.load(f)))
+    if not manifests:
+        raise ValueError(f"No shard manifest found in {paths}")
+    first = manifests[0][1]
+    n_shards = first["shard"][1]
+    seen = {}
+    for folder, manifest in manifests:
+        for key in ("source_hash", "options"):
+            if manifest[key] != first[key]:
+                raise ValueError(
+                    f"Shard {manifest['shard']} in {folder} has another {key} than shard {first['shard']}, they are not from the same run"
+                )
+        k, n = manifest["shard"]
+        if n != n_shards:
+            raise ValueError(f"Shard {k}/{n} in {folder} is not one of {n_shards} shards")
+        if k in seen:
+            raise ValueError(f"Shard {k}/{n} found twice, in {seen[k]} and {folder}")
+        seen[k] = folder
+    missing = sorted(set(range(1, n_shards + 1)) - set(seen))
+    if missing:
+        raise ValueError(f"Missing shards {missing} of {n_shards}")
+
+    entries, rows, detections = {}, [], []
+    for folder, manifest in manifests:
+        copy = os.path.realpath(folder) != os.path.realpath(save_path)
+        copied = set()  # the containers of a packed output hold several pages
+        for entry in manifest["entries"]:
+            if entry["page"] in entries:
+                raise ValueError(f"Page {entry['page']} is in more than one shard")
+            entries[entry["page"]] = entry
+            for file in entry["files"] if copy else ():
+                if file in copied:
+                    continue
+                target = os.path.join(save_path, file)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(os.path.join(folder, file), target)
+                copied.add(file)
+        if first["options"].get("pack"):
+            rows.extend(read_index(os.path.join(folder, index_name(manifest["shard"]))))
+        if first["options"].get("detect_only"):
+            path = os.path.join(folder, detection_name(manifest["shard"]))
+            detections.extend(read_index(path))
+    os.makedirs(save_path, exist_ok=True)
+    if rows:
+        write_index(os.path.join(save_path, index_name()), sort_rows(rows))
+    if detections:
+        detections.sort(key=lambda row: row["page"])
+        write_index(os.path.join(save_path, detection_name()), detections)
+    merged = dict(first, shard=[1, 1], entries=[entries[p] for p in sorted(entries)])
+    merged["shards"] = n_shards
+    write_json(os.path.join(save_path, manifest_name()), merged)
+    return merged
@@ -0,0 +1,126 @@
+import os
+import cv2 as cv
+import pdfplumber
+from PIL import Image
+
+from .cropper import find_objects, crop_object, read_image
+from .render import render_page
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp")
+
+
+class CropRecord:
+    """
+    description:
+      A lightweight record of a single object found on a page, the crop itself is only materialised when `image` is accessed
+
+    attribute:
+      page: int for pdf input (the page number), str for image input (the file name without extension)
+      index: int, the index of the object on its page
+      box: tuple, (x, y, w, h), the bounding box of the object in page pixels
+      contour: numpy array, the outline of the object in page pixels
+      image: numpy array, the padded crop, computed on first access and cached afterwards
+    """
+
+    __slots__ = ("page", "index", "box", "contour", "_original", "_padding", "_image")
+
+    def __init__(self, page, index, contour, original, padding):
+        self.page = page
+        self.index = index
+        self.box = cv.boundingRect(contour)
+        self.contour = contour
+        self._original = original
+        self._padding = padding
+        self._image = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            if self._original is None:
+                raise RuntimeError(
+                    f"The page buffer of {self.page} has been released, access the image before advancing the iterator"
+                )
+            self._image = crop_object(self._original, self.contour, self._padding)
+        return self._image
+
+    def release(self):
+        # drop the reference to the page buffer, so that the page can be freed even if the record is kept
+        self._original = None
+
+    def __repr__(self):
+        return f"CropRecord(page={self.page!r}, index={self.index}, box={self.box})"
+
+
+def iter_pages(src_path, dpi=600, start_page=1, end_page=-1, backend="raster"):
+    """
+    description:
+      yield (page id, PIL Image) for every page of a pdf, an image file, or every image in a folder, one at a time
+    args:
+      src_path: str, path to a pdf file, an image file or a folder containing images
+      dpi: int, resolution used to render pdf pages, omitted for images
+      start_page, end_page: int, 1-based inclusive page range of a pdf, -1 for the last page, omitted for images
+      backend: str, "raster" or "embedded", see render_page, omitted for images
+    """
+    if os.path.isfile(src_path) and src_path.endswith(".pdf"):
+        with pdfplumber.open(src_path) as pdf:
+            n_pages = len(pdf.pages)
+            last_page = n_pages if end_page == -1 else min(end_page, n_pages)
+            for i in range(start_page - 1, last_page):
+                page = pdf.pages[i]
+                img = render_page(page, dpi, backend)[0]
+                page.close()  # release memory
+                yield page.page_number, img
+    elif os.path.isfile(src_path) and src_path.endswith(IMAGE_EXTENSIONS):
+        yield os.path.basename(src_path).split(".")[0], Image.open(src_path)
+    elif os.path.isdir(src_path):
+        for f in sorted(os.listdir(src_path)):
+            if f.endswith(IMAGE_EXTENSIONS):
+                yield f.split(".")[0], Image.open(os.path.join(src_path, f))
+    else:
+        raise ValueError(
+            "Invalid input path, the path should be a pdf or an image or a folder containing images."
+        )
+
+
+def iter_crops(
+    src_path,
+    threshold=(200, 100),
+    padding="white",
+    dpi=600,
+    start_page=1,
+    end_page=-1,
+    detect_scale=1,
+    backend="raster",
+):
+    """
+    description:
+      A streaming alternative to parse_pdf, yielding one CropRecord per object without writing anything to disk. Only one page is held in memory at a time: the page buffer is released, and the records of the page can no longer materialise their crops, once the iterator moves on to the next page.
+    args:
+      src_path: str, path to a pdf file, an image file or a folder containing images
+      threshold: tuple, (int, int), see RubbingCropper
+      padding: str, "white", "black" or "transparent", see RubbingCropper
+      dpi, start_page, end_page: see iter_pages
+      detect_scale: float, see RubbingCropper
+      backend: str, see render_page
+    example:
+      for record in iter_crops("test/test.pdf"):
+          index.add(record.page, record.box, record.image)
+    """
+    for page_id, img in iter_pages(src_path, dpi, start_page, end_page, backend):
+        original, gray = read_image(img)
+        img.close()
+        # pdf pages are selected as the RGB pages of pdfplumber, also the gray and bilevel embedded scans, see RubbingCropper
+        color = len(original.shape) == 3 or src_path.endswith(".pdf")
+        contours = find_objects(gray, threshold, color, detect_scale)[2]
+        del gray
+        records = [
+            CropRecord(page_id, i, cnt, original, padding)
+            for i, cnt in enumerate(contours)
+        ]
+        del original
+        for record in records:
+            yield record
+        # release the page before the next one is rendered
+        for record in records:
+            record.release()
+        del records
@@ -0,0 +1,508 @@
+import os
+import mmap
+import tempfile
+import threading
+from contextlib import contextmanager
+import cv2 as cv
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from .cropper import (
+    KERNEL_SIZE,
+    crop_object,
+    whiten_object,
+    contour_rects,
+    nested_box_mask,
+    valid_rects,
+)
+from .metrics import timed
+
+# bytes held per pixel of a band beside its source channels: the eroded band, the masks and the int32 labels of both colours, and the search of the first pixels
+BAND_BYTES_PER_PIXEL = 16
+# rough bytes per pixel of RubbingCropper beside the decoded image: gray, eroded, binary and the page copies of PIL
+WHOLE_BYTES_PER_PIXEL = 5
+
+
+class BandArray:
+    """
+    description:
+      A uint8 array stored row by row in a file, read and written by windows of rows (and columns) only, so that a huge image never has to be held in memory. Supports the slicing used here, a[y0:y1] and a[y0:y1, x0:x1], reads return copies.
+
+    args:
+      path: str, path to the file
+      shape: tuple, (h, w) or (h, w, channels)
+      offset: int, position of the first row in the file, e.g. the pixel data of an uncompressed tiff
+      writable: bool, open the file for writing too
+    """
+
+    def __init__(self, path, shape, offset=0, writable=False):
+        self.path = path
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.uint8)
+        self.offset = offset
+        self.pixel_bytes = int(np.prod(self.shape[2:], dtype=np.int64))
+        self.row_bytes = self.shape[1] * self.pixel_bytes
+        self.file = open(path, "r+b" if writable else "rb")
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, shape):
+        # a new zero filled array, sparse on most file systems
+        with open(path, "wb") as f:
+            f.truncate(int(np.prod(shape, dtype=np.int64)))
+        return cls(path, shape, writable=True)
+
+    def _window(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        y0, y1, step = key[0].indices(self.shape[0])
+        x0, x1 = 0, self.shape[1]
+        if len(key) > 1:
+            x0, x1, step_x = key[1].indices(self.shape[1])
+            step = step * step_x
+        if step != 1 or len(key) > 2:
+            raise IndexError("BandArray only supports contiguous row and column windows")
+        return y0, max(y0, y1), x0, max(x0, x1)
+
+    def _rows(self, y0, y1, x0, x1):
+        # the file ranges of a window, a single one if the window spans whole rows
+        if x0 == 0 and x1 == self.shape[1]:
+            yield 0, self.offset + y0 * self.row_bytes, (y1 - y0) * self.row_bytes
+        else:
+            for row in range(y0, y1):
+                position = self.offset + row * self.row_bytes + x0 * self.pixel_bytes
+                yield row - y0, position, (x1 - x0) * self.pixel_bytes
+
+    def __getitem__(self, key):
+        y0, y1, x0, x1 = self._window(key)
+        out = np.empty((y1 - y0, x1 - x0) + self.shape[2:], dtype=np.uint8)
+        rows = out.reshape(y1 - y0, -1)
+        with self.lock:
+            for row, position, size in self._rows(y0, y1, x0, x1):
+                self.file.seek(position)
+                view = memoryview(rows[row:]).cast("B")[:size]
+                if self.file.readinto(view) != size:
+                    raise IOError(f"{self.path} is shorter than its image")
+        return out
+
+    def __setitem__(self, key, value):
+        y0, y1, x0, x1 = self._window(key)
+        value = np.ascontiguousarray(value, dtype=np.uint8)
+        rows = value.reshape(y1 - y0, -1)
+        with self.lock:
+            for row, position, size in self._rows(y0, y1, x0, x1):
+                self.file.seek(position)
+                self.file.write(memoryview(rows[row:]).cast("B")[:size])
+            # the page of the output maps the file, it must see every write, see image
+            self.file.flush()
+
+    def image(self):
+        """
+        description:
+          the array as a PIL Image reading straight from the mapped file, e.g. for saving a whitened page without loading it
+        """
+        self.file.flush()
+        mode = "L" if self.ndim == 2 else {3: "RGB", 4: "RGBA"}[self.shape[2]]
+        mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(mapped)[self.offset : self.offset + self.shape[0] * self.row_bytes]
+        size = (self.shape[1], self.shape[0])
+        return Image.frombuffer(mode, size, data, "raw", mode, 0, 1)
+
+    def close(self):
+        self.file.close()
+
+
+@contextmanager
+def open_large(path):
+    # open (and decode) an image of any size, without the decompression bomb check of PIL, the size is what the tiled mode is for
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        with Image.open(path) as img:
+            yield img
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def image_shape(path):
+    """
+    description:
+      the (h, w, channels) of an image file, from its header only
+    """
+    with open_large(path) as img:
+        return img.height, img.width, len(img.getbands())
+
+
+def raw_window(img):
+    """
+    description:
+      the position of the pixels of an uncompressed image whose rows are stored one after the other (uncompressed tiff, ppm/pgm), so that it can be read by windows straight from the file
+    returns:
+      (offset, shape), or None if the image is compressed or stored otherwise
+    """
+    if img.mode not in ("L", "RGB", "RGBA"):
+        return None
+    channels = len(img.mode)
+    row_bytes = img.width * channels
+    offset = None
+    for tile in img.tile:
+        codec, extents, position, args = tile[0], tile[1], tile[2], tile[3]
+        rawmode = args[0] if isinstance(args, tuple) else args
+        orientation = args[2] if isinstance(args, tuple) and len(args) > 2 else 1
+        stride = args[1] if isinstance(args, tuple) and len(args) > 1 else 0
+        if (
+            codec != "raw"
+            or rawmode != img.mode
+            or orientation != 1
+            or stride not in (0, row_bytes)
+            or extents[0] != 0
+            or extents[2] != img.width
+        ):
+            return None
+        if offset is None:
+            offset = position - extents[1] * row_bytes
+        if position != offset + extents[1] * row_bytes:
+            return None  # strips are not stored in order
+    if offset is None:
+        return None
+    shape = (img.height, img.width) if channels == 1 else (img.height, img.width, channels)
+    return offset, shape
+
+
+def open_source(img_input):
+    """
+    description:
+      the original image of the tiled mode, read by windows from the file when it is stored uncompressed, decoded whole once otherwise, which takes the full size of the image in memory on top of the budget of the bands
+    args:
+      img_input: str, path to an image, or numpy array (e.g. np.memmap, np.load(path, mmap_mode="r")), gray, RGB or RGBA
+    returns:
+      BandArray or numpy array
+    """
+    if isinstance(img_input, np.ndarray):
+        return img_input
+    with open_large(img_input) as img:
+        window = raw_window(img)
+        if window is not None:
+            return BandArray(img_input, window[1], window[0])
+        # compressed images are decoded whole by PIL, once, everything after is done by bands
+        if img.mode in ("1", "I", "I;16", "F"):
+            img = img.convert("L")  # as decode_image, bilevel images are not expanded to RGB
+        elif img.mode not in ("L", "RGB", "RGBA"):
+            img = img.convert("RGB")
+        return np.asarray(img)
+
+
+def otsu_threshold(hist):
+    """
+    description:
+      the threshold of Otsu's method over a histogram, computed the same way as cv.THRESH_OTSU, so that the bands are thresholded as the whole image would be
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    scale = 1.0 / hist.sum()
+    mu = float((np.arange(256) * hist).sum() * scale)
+    epsilon = np.finfo(np.float32).eps
+    mu1, q1, max_sigma, max_val = 0.0, 0.0, 0.0, 0
+    for i in range(256):
+        p_i = hist[i] * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma, max_val = sigma, i
+    return max_val
+
+
+def band_rows(width, channels, memory_mb, threads, halo):
+    # the rows of a band such that the bands processed at once fit in the memory budget
+    per_row = width * (channels + BAND_BYTES_PER_PIXEL)
+    rows = int(memory_mb * (1 << 20)) // (threads * per_row) - 2 * halo
+    return max(rows, 2 * halo + 1)
+
+
+def first_pixels(labels, stats):
+    """
+    description:
+      the first pixel in raster order of every component, i.e. the leftmost pixel of its top row, which is where findContours meets its border first
+    returns:
+      numpy array, (n - 1, 2), the (y, x) of the components 1 to n - 1 in band pixels
+    """
+    top = stats[:, 1].astype(np.int32)
+    rows = np.arange(labels.shape[0], dtype=np.int32)[:, None]
+    # only the top rows of the components are searched
+    starts = np.flatnonzero((top[labels] == rows) & (labels > 0))
+    _, first = np.unique(labels.ravel()[starts], return_index=True)
+    position = starts[first]
+    return np.stack([position // labels.shape[1], position % labels.shape[1]], 1)
+
+
+def stitch_components(parts, connectivity):
+    """
+    description:
+      merge the components of the bands which touch across the seams, with a union-find over the labels of the last row of a band and the first row of the next one
+    args:
+      parts: list per band of (stats, seeds, left, first row labels, last row labels), stats as cv.connectedComponentsWithStats without the background and seeds (y, x) in page pixels
+      connectivity: int, 4 or 8, 8 also merges diagonal neighbours
+    returns:
+      (group, merged), group is the index of the merged component of every band component (in band order), merged is a (m, 8) array of x0, y0, x1, y1 (exclusive), area, seed y, seed x and the band component holding the seed
+    """
+    offsets = np.cumsum([0] + [len(part[0]) for part in parts])
+    parent = np.arange(offsets[-1])
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(parts) - 1):
+        upper, lower = parts[i][4], parts[i + 1][3]
+        neighbours = [(upper, lower)]
+        if connectivity == 8:
+            neighbours += [(upper[1:], lower[:-1]), (upper[:-1], lower[1:])]
+        for a, b in neighbours:
+            touching = (a > 0) & (b > 0)
+            pairs = np.stack(
+                [a[touching] - 1 + offsets[i], b[touching] - 1 + offsets[i + 1]], 1
+            )
+            for x, y in np.unique(pairs, axis=0):
+                rx, ry = find(x), find(y)
+                if rx != ry:
+                    parent[max(rx, ry)] = min(rx, ry)
+    roots = np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+    _, group = np.unique(roots, return_inverse=True)
+    stats = np.concatenate([part[0] for part in parts]).astype(np.int64)
+    seeds = np.concatenate([part[1] for part in parts]).astype(np.int64)
+    n = group.max() + 1 if len(group) else 0
+    merged = np.zeros((n, 8), dtype=np.int64)
+    merged[:, 0:2] = np.iinfo(np.int64).max
+    np.minimum.at(merged[:, 0], group, stats[:, 0])
+    np.minimum.at(merged[:, 1], group, stats[:, 1])
+    np.maximum.at(merged[:, 2], group, stats[:, 0] + stats[:, 2])
+    np.maximum.at(merged[:, 3], group, stats[:, 1] + stats[:, 3])
+    np.add.at(merged[:, 4], group, stats[:, 4])
+    # the seed of a merged component is the first one of its parts in raster order
+    order = np.lexsort((seeds[:, 1], seeds[:, 0], group))
+    _, first = np.unique(group[order], return_index=True)
+    merged[:, 5:7] = seeds[order[first]]
+    merged[:, 7] = order[first]
+    return group, merged
+
+
+def left_of_seeds(merged, parts, other_parts, other_group):
+    # the merged component of the other colour on the left of every seed, -1 at the left border of the page
+    band = np.repeat(np.arange(len(parts)), [len(part[0]) for part in parts])
+    left = np.concatenate([part[2] for part in parts]).astype(np.int64)
+    if len(other_group) == 0:
+        # no component of the other colour at all, e.g. a blank page
+        return np.full(len(merged), -1, dtype=np.int64)
+    other_offsets = np.cumsum([0] + [len(part[0]) for part in other_parts])
+    part = merged[:, 7]
+    label = left[part]
+    index = other_offsets[band[part]] + label - 1
+    return np.where(label > 0, other_group[np.maximum(index, 0)], -1)
+
+
+class TiledCropper:
+    """
+    description:
+      A memory bounded version of RubbingCropper for very large images. The page is eroded by bands of rows with a halo of half the kernel, so that the result is the one of the whole page, binarized with a single Otsu threshold computed over all the bands, and its dark components are stitched across the band seams. Only the outline of each candidate object is then traced, on its own bounding box. The gray and eroded pages live in scratch files, and uncompressed images are read by windows straight from their file, so that the memory used by the bands stays around memory_mb whatever the size of the image. Compressed images are decoded whole once beforehand, see open_source, which the budget does not cover.
+      The hierarchy of findContours on the whole page is rebuilt from the components: the parent of a contour is the component on the left of its first pixel, and contour 0 is the top level white component met last. The objects, crops and whitened page are checked against RubbingCropper's by test/test_tiled.py.
+
+    args:
+      img_input: str or numpy array, see open_source
+      threshold, mode, padding: see RubbingCropper
+      memory_mb: float, memory budget of the bands processed at once, in MB
+      threads: int, number of bands processed at once
+      scratch_dir: str, folder of the scratch files, the system temporary folder by default, they take twice the pixels of the image on disk
+      metrics: PageMetrics, optional, see RubbingCropper
+
+    attribute:
+      contours: the outlines of the objects in page pixels
+      boxes: their bounding boxes
+      output: same as RubbingCropper, except that images is a generator cropping (and whitening) one object at a time, and page is a PIL Image mapped from the scratch file, which is valid until close
+    """
+
+    def __init__(
+        self,
+        img_input,
+        threshold=(200, 150),
+        mode="poly",
+        padding="white",
+        memory_mb=1024,
+        threads=2,
+        scratch_dir=None,
+        metrics=None,
+    ):
+        self.mode = mode
+        self.padding = padding
+        self.metrics = metrics
+        self.scratch = tempfile.TemporaryDirectory(prefix="cropper-", dir=scratch_dir)
+        with timed(metrics, "decode"):
+            self.original = open_source(img_input)
+        height, width = self.original.shape[:2]
+        channels = 1 if self.original.ndim == 2 else self.original.shape[2]
+        self.gray = BandArray.create(
+            os.path.join(self.scratch.name, "gray"), (height, width)
+        )
+        self.eroded = BandArray.create(
+            os.path.join(self.scratch.name, "eroded"), (height, width)
+        )
+        halo = KERNEL_SIZE // 2
+        rows = band_rows(width, channels, memory_mb, threads, halo)
+        bands = [(y, min(y + rows, height)) for y in range(0, height, rows)]
+        with ThreadPoolExecutor(threads) as pool:
+            with timed(metrics, "erode"):
+                hist = sum(pool.map(lambda band: self._erode_band(*band, halo), bands))
+            with timed(metrics, "threshold"):
+                self.level = otsu_threshold(hist)
+            with timed(metrics, "components"):
+                parts = list(pool.map(lambda band: self._label_band(*band), bands))
+        with timed(metrics, "stitch"):
+            dark_parts, white_parts = zip(*parts)
+            dark_group, dark = stitch_components(dark_parts, 4)
+            white_group, white = stitch_components(white_parts, 8)
+            # the parents of the contours in the hierarchy of findContours, from the colour on the left of their first pixel
+            dark_left = left_of_seeds(dark, dark_parts, white_parts, white_group)
+            white_left = left_of_seeds(white, white_parts, dark_parts, dark_group)
+        del parts, dark_parts, white_parts
+        # dark components touching the border are part of the frame around the page rather than holes
+        x0, y0, x1, y1 = dark[:, 0], dark[:, 1], dark[:, 2], dark[:, 3]
+        hole = (x0 > 0) & (y0 > 0) & (x1 < width) & (y1 < height)
+        white_parent = np.full(len(white), -1, dtype=np.int64)
+        inside = white_left >= 0
+        white_parent[inside] = np.where(hole[white_left[inside]], white_left[inside], -1)
+        # contour 0 is the outline of the top level white component met last, as findContours lists the siblings of its hierarchy in the reverse of the order it meets them
+        top = np.flatnonzero(white_parent == -1)
+        first_white = top[np.lexsort((white[top, 6], white[top, 5]))[-1:]]
+        # the outline of a hole runs on the white pixels around it, hence the 2 extra pixels
+        rects = np.stack([x0 - 1, y0 - 1, x1 - x0 + 2, y1 - y0 + 2], 1)
+        selected = valid_rects(rects, threshold) & hole & np.isin(dark_left, first_white)
+        components, outer = dark[selected], False
+        if self.original.ndim == 3 and not selected.any():
+            # the colour image fallback of select_contours, the outer outlines of the white components at the top level
+            x0, y0, x1, y1 = white[:, 0], white[:, 1], white[:, 2], white[:, 3]
+            rects = np.stack([x0, y0, x1 - x0, y1 - y0], 1)
+            selected = valid_rects(rects, threshold) & (white_parent == -1)
+            components, outer = white[selected], True
+        # in the order findContours returns them, the reverse of the order it meets them
+        components = components[np.lexsort((components[:, 6], components[:, 5]))[::-1]]
+        with timed(metrics, "find_contours"):
+            contours = [self._trace(component, outer) for component in components]
+            contours = [cnt for cnt in contours if cnt is not None]
+        with timed(metrics, "select"):
+            kept = nested_box_mask(contour_rects(contours))
+            self.contours = [cnt for cnt, keep in zip(contours, kept) if keep]
+        self.boxes = [cv.boundingRect(cnt) for cnt in self.contours]
+        if metrics is not None:
+            metrics.count("bands", len(bands))
+            metrics.count("contours", len(dark) + len(white))
+            metrics.count("objects", len(self.contours))
+        self.output = {
+            "images": self.iter_images(),
+            "page": self.gray.image(),
+            "boxes": self.boxes,
+        }
+
+    def _erode_band(self, y0, y1, halo):
+        top, bottom = max(0, y0 - halo), min(self.gray.shape[0], y1 + halo)
+        tile = np.ascontiguousarray(self.original[top:bottom])
+        # the same conversion as read_image
+        gray = tile if tile.ndim == 2 else np.asarray(Image.fromarray(tile).convert("L"))
+        del tile
+        self.gray[y0:y1] = gray[y0 - top : y1 - top]
+        eroded = cv.erode(gray, np.ones((KERNEL_SIZE, KERNEL_SIZE), np.uint8))
+        core = eroded[y0 - top : y1 - top]
+        self.eroded[y0:y1] = core
+        return np.bincount(core.ravel(), minlength=256)
+
+    def _label_band(self, y0, y1):
+        # the dark pixels binarize to 0 with the threshold of the whole page, findContours follows the white ones 8-connected and the dark ones 4-connected
+        dark = (self.eroded[y0:y1] <= self.level).view(np.uint8)
+        parts = []
+        for mask, connectivity in ((dark, 4), (1 - dark, 8)):
+            _, labels, stats, _ = cv.connectedComponentsWithStats(
+                mask, connectivity=connectivity, ltype=cv.CV_32S
+            )
+            seeds = first_pixels(labels, stats)
+            parts.append((labels, stats[1:].astype(np.int64), seeds))
+        bands = []
+        for (labels, stats, seeds), (other, _, _) in zip(parts, parts[::-1]):
+            # the label of the other colour on the left of every seed, 0 at the left border
+            left = np.where(
+                seeds[:, 1] > 0, other[seeds[:, 0], np.maximum(seeds[:, 1] - 1, 0)], 0
+            )
+            stats[:, 1] += y0
+            seeds[:, 0] += y0
+            bands.append((stats, seeds, left, labels[0].copy(), labels[-1].copy()))
+        return bands
+
+    def _trace(self, component, outer=False):
+        # the outline of a single component, traced on its bounding box with every other component removed
+        x0, y0, x1, y1, area = component[:5]
+        white = self.eroded[y0:y1, x0:x1] > self.level
+        mask = (white if outer else ~white).view(np.uint8)
+        _, labels, stats, _ = cv.connectedComponentsWithStats(
+            mask, connectivity=8 if outer else 4
+        )
+        match = np.flatnonzero(
+            (stats[:, 0] == 0)
+            & (stats[:, 1] == 0)
+            & (stats[:, 2] == x1 - x0)
+            & (stats[:, 3] == y1 - y0)
+            & (stats[:, 4] == area)
+        )
+        match = match[match > 0]
+        if len(match) == 0:
+            return None
+        if outer:
+            binary = np.zeros((y1 - y0 + 4, x1 - x0 + 4), dtype=np.uint8)
+            binary[2:-2, 2:-2][labels == match[0]] = 255
+        else:
+            binary = np.full((y1 - y0 + 4, x1 - x0 + 4), 255, dtype=np.uint8)
+            binary[2:-2, 2:-2][labels == match[0]] = 0
+        contours, hierarchy = cv.findContours(
+            binary, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE, offset=(x0 - 2, y0 - 2)
+        )
+        # the outer outline of the white component, or the hole in the white frame around the dark one
+        found = np.flatnonzero(hierarchy[0][:, 3] == (-1 if outer else 0))
+        return contours[found[0]] if len(found) else None
+
+    def iter_images(self):
+        """
+        description:
+          crop the objects one at a time, whitening each one on the gray page once cropped
+        """
+        for cnt in self.contours:
+            with timed(self.metrics, "crop"):
+                crop = crop_object(self.original, cnt, self.padding)
+            with timed(self.metrics, "whiten"):
+                x, y, w, h = cv.boundingRect(cnt)
+                y1, x1 = min(y + h + 1, self.gray.shape[0]), min(x + w + 1, self.gray.shape[1])
+                region = self.gray[y:y1, x:x1]
+                whiten_object(region, cnt - np.array([x, y], dtype=cnt.dtype), self.mode)
+                self.gray[y:y1, x:x1] = region
+            yield crop
+
+    def close(self):
+        # remove the scratch files, the page of the output is no longer readable afterwards
+        self.output["page"] = None
+        self.gray.close()
+        self.eroded.close()
+        if isinstance(self.original, BandArray):
+            self.original.close()
+        self.scratch.cleanup()
+
+
+def needs_tiling(path, memory_mb):
+    """
+    description:
+      whether processing an image whole would exceed the memory budget, from its header only
+    """
+    height, width, channels = image_shape(path)
+    return height * width * (channels + WHOLE_BYTES_PER_PIXEL) > memory_mb * (1 << 20)
@@ -0,0 +1,149 @@
+import io
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from .bilevel import BitImage
+
+# file extension and PIL save arguments of every supported output format
+FORMATS = {
+    "png": ".png",
+    "webp": ".webp",
+    "tiff": ".tif",
+}
+
+
+def save_options(fmt, compress_level, dpi):
+    """
+    description:
+      the PIL save arguments of an output format, all of them lossless
+    args:
+      fmt: str, "png", "webp" or "tiff"
+      compress_level: int, 0-9, zlib level for png, mapped to the effort (method 0-6) for webp, tiff is deflate compressed unless 0
+      dpi: int, resolution written into the file, webp has no dpi field
+    """
+    if fmt == "png":
+        return dict(format="PNG", compress_level=compress_level, dpi=(dpi, dpi))
+    elif fmt == "webp":
+        return dict(format="WEBP", lossless=True, method=round(compress_level * 6 / 9))
+    elif fmt == "tiff":
+        compression = "tiff_adobe_deflate" if compress_level > 0 else None
+        return dict(format="TIFF", compression=compression, dpi=(dpi, dpi))
+    raise ValueError(f"Invalid output format {fmt}, must be one of {list(FORMATS)}")
+
+
+def to_image(array, options):
+    """
+    description:
+      the PIL image of an image to be written, and its save arguments. Bilevel images (BitImage or 1-bit PIL images) are written as 1-bit png, as CCITT group 4 tiff unless uncompressed, and as gray webp, which has no 1-bit mode
+    args:
+      array: numpy array, PIL Image or BitImage
+      options: dict, see save_options
+    """
+    if isinstance(array, BitImage):
+        image = array.to_image()
+    elif isinstance(array, Image.Image):
+        image = array
+    else:
+        image = Image.fromarray(array)
+    if image.mode == "1":
+        if options["format"] == "TIFF" and options["compression"] is not None:
+            options = dict(options, compression="group4")
+        elif options["format"] == "WEBP":
+            image = image.convert("L")
+    return image, options
+
+
+class ImageWriter:
+    """
+    description:
+      A writer stage encoding and saving images on a pool of threads, so that encoding overlaps with the detection of the next page. Every image is written to a temporary file renamed once complete, so that an interrupted run never leaves a truncated image under its final name. PIL releases the GIL while compressing, hence the threads run in parallel. At most max_pending images are queued, submit blocks beyond that, which bounds the memory held by images waiting to be written.
+
+    args:
+      save_path: str, path to the output folder, its subfolders are created once here
+      subfolders: list of str, the subfolders images are written to
+      fmt: str, "png", "webp" or "tiff", see save_options
+      compress_level: int, 0-9, see save_options
+      dpi: int, resolution written into the files
+      threads: int, number of encoding threads
+      max_pending: int, maximum number of images queued or being written, defaults to 4 per thread
+      pack: PackWriter, optional, the images of the "images" subfolder are then appended to its containers instead of being written as files, the writer closes it
+      tag: str, tag of the temporary files, {file}.{tag}.{pid}.tmp, unique to the run or shard writing into save_path, see partial_tag
+    """
+
+    def __init__(
+        self,
+        save_path,
+        subfolders=("images",),
+        fmt="png",
+        compress_level=6,
+        dpi=600,
+        threads=2,
+        max_pending=None,
+        pack=None,
+        tag="part",
+    ):
+        self.save_path = save_path
+        self.extension = FORMATS[fmt]
+        self.options = save_options(fmt, compress_level, dpi)
+        self.dpi = dpi
+        for subfolder in subfolders:
+            os.makedirs(os.path.join(save_path, subfolder), exist_ok=True)
+        self.executor = ThreadPoolExecutor(threads)
+        self.slots = threading.BoundedSemaphore(max_pending or 4 * threads)
+        self.pack = pack
+        self.tag = tag
+
+    def submit(self, subfolder, name, array, dpi=None, meta=None):
+        """
+        description:
+          queue an ndarray (or a PIL Image, e.g. the memory mapped page of the tiled mode, or a BitImage, see to_image) to be written as save_path/subfolder/name + extension
+        args:
+          dpi: int, optional resolution of this image, overriding the one of the writer, e.g. for pages at their scan resolution
+          meta: dict, optional index row of a packed image, see PackWriter.add
+        returns:
+          Future, its result is (path relative to save_path, seconds spent encoding and writing, bytes written), the path is the one of the container for packed images
+        """
+        self.slots.acquire()
+        file = f"{subfolder}/{name}{self.extension}"
+        options = self.options
+        if dpi is not None and "dpi" in options:
+            options = dict(options, dpi=(dpi, dpi))
+        try:
+            if self.pack is not None and subfolder == "images":
+                meta = dict(meta or {}, dpi=dpi if dpi is not None else self.dpi)
+                future = self.executor.submit(
+                    self._pack, f"{name}{self.extension}", array, options, meta
+                )
+            else:
+                future = self.executor.submit(self._write, file, array, options)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _write(self, file, array, options):
+        start = time.perf_counter()
+        path = os.path.join(self.save_path, file)
+        tmp_path = f"{path}.{self.tag}.{os.getpid()}.tmp"
+        image, options = to_image(array, options)
+        image.save(tmp_path, **options)
+        os.replace(tmp_path, path)
+        return file, time.perf_counter() - start, os.path.getsize(path)
+
+    def _pack(self, name, array, options, meta):
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        image, options = to_image(array, options)
+        image.save(buffer, **options)
+        file = self.pack.add(name, buffer.getvalue(), meta)
+        return file, time.perf_counter() - start, buffer.tell()
+
+    def close(self):
+        # wait for every queued image to be written
+        self.executor.shutdown(wait=True)
+        if self.pack is not None:
+            self.pack.close()
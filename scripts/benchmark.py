@@ -0,0 +1,502 @@
+from PIL import Image, ImageDraw
+import numpy as np
+import os, sys
+import json
+import time
+import pickle
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+import pdfplumber
+
+# import local modules, the other scripts too are imported from the repository root, not from the folder the benchmark is run from
+sys.path.append("..")
+from modules.cropper import KERNEL_SIZE, PageDetection, Selection, select_contours
+from modules.render import render_page
+from modules.metrics import peak_rss_mb
+from scripts.numbering import assign_numbers
+from scripts.pdfcropper import positive_float
+
+STAGES = ("render", "detect", "select", "crop", "encode", "numbering")
+
+
+def synth_page(width, height, n_objects, color, rng):
+    """
+    description:
+      draw a page with n_objects irregular rubbing-like blobs in a grid, each with a small number label below it, on a blank paper background
+    returns:
+      (PIL Image, list of label boxes (x, y, w, h) in page pixels)
+    """
+    paper = (236, 228, 210) if color else 255
+    page = Image.new("RGB" if color else "L", (width, height), paper)
+    draw = ImageDraw.Draw(page)
+    cols = max(1, int(np.ceil(np.sqrt(n_objects * width / height))))
+    rows = max(1, int(np.ceil(n_objects / cols)))
+    cell_w, cell_h = width // cols, height // rows
+    labels = []
+    for k in range(n_objects):
+        cx = (k % cols) * cell_w + cell_w // 2
+        cy = (k // cols) * cell_h + int(cell_h * 0.45)
+        # a closed outline with a noisy radius, filled with a darker tone like a rubbing
+        angles = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+        radius = 1 + 0.15 * rng.standard_normal(len(angles))
+        rx, ry = cell_w * 0.35, cell_h * 0.3
+        points = [
+            (cx + rx * r * np.cos(a), cy + ry * r * np.sin(a))
+            for a, r in zip(angles, radius)
+        ]
+        ink = (40, 35, 30) if color else 40
+        draw.polygon(points, fill=(90, 80, 70) if color else 90, outline=ink)
+        draw.line(points + points[:1], fill=ink, width=max(2, width // 600))
+        # the number label, a few digit-sized blocks centered below the object
+        digit_w, digit_h = max(2, width // 160), max(3, height // 150)
+        n_digits = int(rng.integers(1, 5))
+        label_x = cx - n_digits * digit_w
+        label_y = cy + int(ry * 1.35)
+        for d in range(n_digits):
+            x0 = label_x + d * 2 * digit_w
+            draw.rectangle((x0, label_y, x0 + digit_w, label_y + digit_h), fill=ink)
+        labels.append((label_x, label_y, n_digits * 2 * digit_w, digit_h))
+    # scanner noise
+    pixels = np.array(page, dtype=np.int16)
+    pixels += rng.integers(-12, 13, pixels.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)), labels
+
+
+def pathological_page(width, height, stroke_height, rng, strokes=0.5):
+    """
+    description:
+      draw a page of scanner dust, the worst case of the contour filtering: a dot every few pixels, just far enough apart to stay separate contours once eroded, and among them short strokes tall enough to pass the text threshold. At 600dpi that is about 20k contours of which about 3k pass the filters, all of which go through the nested box merge
+    args:
+      stroke_height: int, the height of the strokes, e.g. the text threshold height, the erosion makes them taller
+      strokes: float, the share of the columns of dots replaced by a stroke
+    returns:
+      (PIL Image, list of label boxes), the page has no labels
+    """
+    page = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(page)
+    dot = max(2, width // 1600)
+    # the dots grow by half the kernel on every side once eroded, they must stay apart
+    pitch = KERNEL_SIZE + dot + 8
+    cell_h = stroke_height + 2 * pitch
+    for y in range(pitch // 2, height - cell_h, cell_h):
+        for x in range(pitch // 2, width - pitch, pitch):
+            if rng.random() < strokes:
+                draw.rectangle((x, y, x + dot, y + stroke_height), fill=40)
+            else:
+                for dy in range(0, cell_h - pitch, pitch):
+                    draw.rectangle((x, y + dy, x + dot, y + dy + dot), fill=40)
+    return page, []
+
+
+def legacy_select(contours, hierarchy, threshold=(200, 150), color=False):
+    """
+    description:
+      select_contours as it was before its filters were vectorised and the nested box merge swept, a boundingRect call per test and an O(n^2) merge, the reference of the select stage
+    """
+
+    def pick(parent):
+        return [
+            cnt
+            for i, cnt in enumerate(contours)
+            if hierarchy[0][i][3] == parent
+            and (
+                cv.boundingRect(cnt)[2] > threshold[0]
+                or cv.boundingRect(cnt)[3] > threshold[1]
+            )
+            and cv.boundingRect(cnt)[2] / cv.boundingRect(cnt)[3] < 5
+        ]
+
+    valid_contours = pick(0)
+    if color and len(valid_contours) == 0:
+        valid_contours = pick(-1)
+    boxes = [cv.boundingRect(cnt) for cnt in valid_contours]
+    to_remove = []
+    for i, box in enumerate(boxes):
+        for j, other_box in enumerate(boxes):
+            if i != j:
+                if (
+                    box[0] <= other_box[0]
+                    and box[1] <= other_box[1]
+                    and box[0] + box[2] >= other_box[0] + other_box[2]
+                    and box[1] + box[3] >= other_box[1] + other_box[3]
+                ):
+                    to_remove.append(j)
+    return [cnt for i, cnt in enumerate(valid_contours) if i not in to_remove]
+
+
+def build_workload(
+    work_dir,
+    pages,
+    dpi,
+    objects,
+    color,
+    src_pdf=None,
+    seed=0,
+    pathological=False,
+    stroke_height=100,
+):
+    """
+    description:
+      write the input pdf of the benchmark, either synthetic pages or the pages of src_pdf repeated, plus an ocr pdf holding one number per object for the numbering stage
+    args:
+      pathological, stroke_height: draw pathological pages instead of rubbings, see pathological_page
+    returns:
+      (path to the pdf, path to the ocr pdf or None for a replicated pdf or pathological pages)
+    """
+    pdf_path = os.path.join(work_dir, "input.pdf")
+    ocr_path = None
+    if src_pdf is not None:
+        # replicate the pages of a real pdf, rendered once, to the requested page count
+        with pdfplumber.open(src_pdf) as pdf:
+            templates = [
+                p.to_image(resolution=dpi, antialias=True).original for p in pdf.pages
+            ]
+    else:
+        rng = np.random.default_rng(seed)
+        # a4 paper, a few distinct templates are repeated to keep the synthesis cheap
+        width, height = int(8.27 * dpi), int(11.69 * dpi)
+        synth = [
+            (
+                pathological_page(width, height, stroke_height, rng)
+                if pathological
+                else synth_page(width, height, objects, color, rng)
+            )
+            for _ in range(min(pages, 4))
+        ]
+        templates = [img for img, _ in synth]
+        ocr_pages = [
+            (width * 72 / dpi, height * 72 / dpi, labels, 72 / dpi)
+            for _, labels in synth
+        ]
+        if not pathological:
+            ocr_path = os.path.join(work_dir, "ocr.pdf")
+            write_text_pdf(
+                ocr_path, [ocr_pages[i % len(synth)] for i in range(pages)]
+            )
+    images = (templates[i % len(templates)] for i in range(1, pages))
+    templates[0].save(
+        pdf_path, save_all=True, append_images=images, resolution=dpi, quality=90
+    )
+    return pdf_path, ocr_path
+
+
+def write_text_pdf(path, pages):
+    """
+    description:
+      write a minimal pdf with a text layer only, one number word at each label box, used as the ocr pdf of the numbering stage
+    args:
+      pages: list of (width, height, label boxes, scale), page size in points, label boxes in pixels, scale from pixels to points
+    """
+    objects = ["<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    pages_id = 2 + 2 * len(pages)
+    for width, height, labels, scale in pages:
+        stream = ""
+        for k, (x, y, w, h) in enumerate(labels):
+            size = max(1, round(h * scale))
+            left, baseline = x * scale, height - (y + h) * scale
+            stream += f"BT /F1 {size} Tf {left:.2f} {baseline:.2f} Td ({k + 1}) Tj ET\n"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}endstream")
+        objects.append(
+            f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 {width:.2f} {height:.2f}] "
+            f"/Contents {len(objects)} 0 R /Resources << /Font << /F1 1 0 R >> >> >>"
+        )
+        kids.append(len(objects))
+    objects.append(
+        f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {len(kids)} >>"
+    )
+    objects.append(f"<< /Type /Catalog /Pages {pages_id} 0 R >>")
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n{obj}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root {len(objects)} 0 R >>\n".encode()
+    out += f"startxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def run_stage(stage, work_dir, pdf_path, ocr_path, dpi, threshold, detect_scale):
+    """
+    description:
+      run a single stage over all the pages, reading the output of the previous stage from work_dir one page at a time, only the stage itself is timed. The stages are those of pdfcropper.py: render_page, the decode (read_image), detection and selection of PageDetection, and the crop and whitening of Selection.extract, pdf pages are selected as colour pages as there
+    returns:
+      dict, the seconds spent, the number of pages, and the memory before and after the stage, for the select stage also the seconds of legacy_select on the same contours
+    """
+    base_rss = peak_rss_mb()
+    pages_dir = os.path.join(work_dir, "stage")
+    elapsed = 0
+    extra = {}
+    with pdfplumber.open(pdf_path) as pdf:
+        n_pages = len(pdf.pages)
+        for i in range(n_pages if stage != "numbering" else 0):
+            stem = os.path.join(pages_dir, str(i + 1))
+            if stage == "render":
+                page = pdf.pages[i]
+                start = time.perf_counter()
+                img = render_page(page, dpi)[0]
+                page.close()
+                elapsed += time.perf_counter() - start
+                np.save(f"{stem}.npy", np.asarray(img))
+            elif stage == "detect":
+                original = np.load(f"{stem}.npy")
+                start = time.perf_counter()
+                detection = PageDetection(original, detect_scale, color=True)
+                contours = detection.select(threshold).contours
+                elapsed += time.perf_counter() - start
+                with open(f"{stem}.pkl", "wb") as f:
+                    found = (detection.contours, detection.hierarchy, detection.level)
+                    pickle.dump((found, contours), f)
+            elif stage == "select":
+                # only the selection is timed, on the contours of the page, which are not refined below detection scale 1
+                detection = PageDetection(
+                    np.load(f"{stem}.npy"), detect_scale, color=True
+                )
+                args = (detection.contours, detection.hierarchy, threshold)
+                start = time.perf_counter()
+                contours = select_contours(*args, detection.color)
+                elapsed += time.perf_counter() - start
+                start = time.perf_counter()
+                reference = legacy_select(*args, detection.color)
+                extra["legacy_seconds"] = extra.get("legacy_seconds", 0) + (
+                    time.perf_counter() - start
+                )
+                extra["contours"] = extra.get("contours", 0) + len(detection.contours)
+                if [cv.boundingRect(c) for c in contours] != [
+                    cv.boundingRect(c) for c in reference
+                ]:
+                    raise RuntimeError(
+                        f"select_contours differs from legacy_select on page {i + 1}"
+                    )
+            elif stage == "crop":
+                original = np.load(f"{stem}.npy")
+                with open(f"{stem}.pkl", "rb") as f:
+                    found, contours = pickle.load(f)
+                start = time.perf_counter()
+                # the detection is given, only the page is decoded again, then cropped and whitened in place as by RubbingCropper
+                detection = PageDetection(original, detect_scale, found, color=True)
+                output = Selection(detection, contours).extract(
+                    "poly", "white", inplace=True
+                )
+                elapsed += time.perf_counter() - start
+                with open(f"{stem}.crops.pkl", "wb") as f:
+                    pickle.dump((output["images"], output["page"], output["boxes"]), f)
+            elif stage == "encode":
+                with open(f"{stem}.crops.pkl", "rb") as f:
+                    crops, gray, boxes = pickle.load(f)
+                start = time.perf_counter()
+                for crop, box in zip(crops, boxes):
+                    Image.fromarray(crop).save(
+                        os.path.join(work_dir, "images", f"{i + 1}-{list(box)}.png"),
+                        dpi=(dpi, dpi),
+                    )
+                Image.fromarray(gray).save(
+                    os.path.join(work_dir, "pages", f"{i + 1}.png"), dpi=(dpi, dpi)
+                )
+                elapsed += time.perf_counter() - start
+    if stage == "numbering":
+        with pdfplumber.open(ocr_path) as ocr:
+            n_pages = len(ocr.pages)
+        start = time.perf_counter()
+        assign_numbers(
+            os.path.join(work_dir, "images"), os.path.join(work_dir, "pages"), ocr_path
+        )
+        elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "pages": n_pages,
+        "pages_per_sec": n_pages / elapsed if elapsed > 0 else None,
+        "base_rss_mb": base_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+
+def benchmark(
+    pages=10,
+    dpi=600,
+    objects=6,
+    color=False,
+    src_pdf=None,
+    text_threshold=(200, 100),
+    detect_scale=1,
+    stages=STAGES,
+    work_dir=None,
+    pathological=False,
+):
+    """
+    description:
+      build a workload and time every stage of the pipeline on it, each stage runs in a fresh process so that its peak memory is measured on its own
+    returns:
+      dict, the configuration, the environment and the result of every stage, ready to be dumped as json
+    """
+    keep = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="cropper-bench-")
+    for sub in ("stage", "images", "pages"):
+        os.makedirs(os.path.join(work_dir, sub), exist_ok=True)
+    config = dict(
+        pages=pages,
+        dpi=dpi,
+        objects=objects,
+        color=color,
+        src_pdf=src_pdf,
+        text_threshold=list(text_threshold),
+        detect_scale=detect_scale,
+        pathological=pathological,
+    )
+    print(f"Building workload in {work_dir}: {config}")
+    pdf_path, ocr_path = build_workload(
+        work_dir,
+        pages,
+        dpi,
+        objects,
+        color,
+        src_pdf,
+        pathological=pathological,
+        stroke_height=text_threshold[1],
+    )
+    results = {}
+    # spawn rather than fork, so that no memory of the parent is counted in the stage
+    context = multiprocessing.get_context("spawn")
+    try:
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            if stage == "numbering" and ocr_path is None:
+                print(
+                    "numbering skipped, replicated pdfs and pathological pages have no matching ocr layer"
+                )
+                continue
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                results[stage] = executor.submit(
+                    run_stage,
+                    stage,
+                    work_dir,
+                    pdf_path,
+                    ocr_path,
+                    dpi,
+                    text_threshold,
+                    detect_scale,
+                ).result()
+            print(
+                f"{stage:>10}: {results[stage]['seconds']:8.2f}s, "
+                f"{results[stage]['pages_per_sec'] or 0:8.2f} pages/s, "
+                f"peak rss {results[stage]['peak_rss_mb'] or 0:8.1f} MB"
+            )
+            if stage == "select":
+                legacy = results[stage]["legacy_seconds"]
+                print(
+                    f"{'legacy':>10}: {legacy:8.2f}s, "
+                    f"{legacy / max(results[stage]['seconds'], 1e-9):8.1f}x slower, "
+                    f"{results[stage]['contours']} contours"
+                )
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "config": config,
+        "environment": dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            numpy=np.__version__,
+            opencv=cv.__version__,
+            pdfplumber=pdfplumber.__version__,
+        ),
+        "stages": results,
+    }
+
+
+if __name__ == "__main__":
+    # Usage example: python benchmark.py --pages=20 --dpi=600 --objects=8 --color=False --output="../bench.json"
+    parser = argparse.ArgumentParser(
+        description="Benchmark the render, detect, crop, encode and numbering stages of the cropper on a synthetic or replicated workload"
+    )
+    parser.add_argument(
+        "--pages", type=int, default=10, help="number of pages of the workload"
+    )
+    parser.add_argument(
+        "--dpi", type=int, default=600, help="resolution the pages are rendered at"
+    )
+    parser.add_argument(
+        "--objects",
+        type=int,
+        default=6,
+        help="number of objects drawn on every synthetic page",
+    )
+    parser.add_argument(
+        "--color",
+        type=lambda x: (str(x).lower() == "true"),
+        default=False,
+        help="if true, synthetic pages are RGB on tinted paper, otherwise grayscale",
+    )
+    parser.add_argument(
+        "--pathological",
+        type=lambda x: (str(x).lower() == "true"),
+        default=False,
+        help="if true, synthetic pages are covered with dust dots and short strokes instead of rubbings, tens of thousands of contours per page at 600dpi, the worst case of the select stage, which compares select_contours with its former implementation, the numbering stage is skipped then",
+    )
+    parser.add_argument(
+        "--src_pdf",
+        type=str,
+        default=None,
+        help="optional pdf whose pages are repeated to build the workload instead of synthetic pages, e.g. ../test/test.pdf, the numbering stage is skipped then",
+    )
+    parser.add_argument(
+        "--text_threshold",
+        type=str,
+        default="200, 100",
+        help="the text threshold used by the detection, see pdfcropper.py",
+    )
+    parser.add_argument(
+        "--detect_scale",
+        type=positive_float,
+        default=1,
+        help="the detection scale, see pdfcropper.py",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        default=",".join(STAGES),
+        help="comma separated stages to run, a stage needs the output of the ones before it",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="folder for the workload and intermediate files, kept after the run, a temporary folder is used and removed if not specified",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="path of the json file the results are written to, compare it between versions to catch regressions",
+    )
+
+    args = parser.parse_args()
+    report = benchmark(
+        args.pages,
+        args.dpi,
+        args.objects,
+        args.color,
+        args.src_pdf,
+        tuple([int(i.strip()) for i in args.text_threshold.split(",")]),
+        args.detect_scale,
+        [s.strip() for s in args.stages.split(",")],
+        args.work_dir,
+        args.pathological,
+    )
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
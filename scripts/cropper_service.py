@@ -0,0 +1,187 @@
+import sys
+import json
+import argparse
+import importlib
+
+# import local modules, only the standard library is imported here, the workers import the rest once
+sys.path.append("..")
+from modules.service import JobService, make_server, submit_job, get_job, wait_job
+
+# the kinds of jobs, and the script whose options (build_parser) and main they use
+JOB_SCRIPTS = {"crop": "pdfcropper", "number": "numbering"}
+
+
+def job_argv(args):
+    """
+    description:
+      the command line of a job from its json arguments, named after the options of its script, e.g. {"src_path": "a.pdf", "text_threshold": [200, 100]} -> ["--src_path=a.pdf", "--text_threshold=200, 100"]
+    """
+    argv = []
+    for key, value in args.items():
+        if isinstance(value, (list, tuple)):
+            value = ", ".join(str(v) for v in value)
+        argv.append(f"--{key}={value}")
+    return argv
+
+
+def parse_job(job):
+    """
+    description:
+      parse the arguments of a job with the parser of its script, so that jobs get the same defaults and checks as the command line
+    returns:
+      (script module, argparse.Namespace)
+    """
+    kind = job.get("kind")
+    if kind not in JOB_SCRIPTS:
+        raise ValueError(f"Invalid job kind {kind!r}, must be one of {list(JOB_SCRIPTS)}")
+    args = job.get("args") or {}
+    if not isinstance(args, dict):
+        raise ValueError("The args of a job must be a json object")
+    script = importlib.import_module(JOB_SCRIPTS[kind])
+    parser = script.build_parser()
+
+    def error(message):
+        # argparse exits on errors, which would take the service down
+        raise ValueError(f"Invalid {kind} job: {message}")
+
+    parser.error = error
+    return script, parser.parse_args(job_argv(args))
+
+
+def validate_job(job):
+    # reject jobs with unknown or invalid options before queueing them
+    parse_job(job)
+    return {"kind": job["kind"], "args": job.get("args") or {}}
+
+
+def run_job(job):
+    """
+    description:
+      run a job in a worker process
+    returns:
+      dict, a summary of the job, the pages and files of a crop job (the full list is in its manifest), the number of bones renamed by a number job
+    """
+    script, args = parse_job(job)
+    result = script.main(args)
+    if job["kind"] == "number":
+        return {"renamed": result}
+    if result is None:
+        raise ValueError(f"Invalid input path {args.src_path}")
+    return {
+        "source": result["source"],
+        "dst_path": args.dst_path,
+        "pages": len(result["entries"]),
+        "files": sum(len(entry["files"]) for entry in result["entries"]),
+    }
+
+
+def warm_up():
+    # import the heavy modules once per worker process, and run a tiny page through the cropper, so that jobs start right away
+    import numpy as np
+    import pdfplumber
+    import tqdm
+    import modules.cache, modules.render, modules.tiled, modules.writer
+    from modules.cropper import RubbingCropper
+
+    RubbingCropper(np.full((64, 64), 255, dtype=np.uint8))
+
+
+def serve(host, port, workers, history, quiet):
+    service = JobService(run_job, validate_job, workers, warm_up, history)
+    server = make_server(service, host, port, quiet)
+    print(f"Serving on http://{server.server_address[0]}:{server.server_address[1]} with {workers} worker(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    # Usage example: python cropper_service.py --port=8765 --workers=4
+    # then: python cropper_service.py --submit='{"kind": "crop", "args": {"src_path": "../test/test.pdf", "dst_path": "../output"}}' --wait=True
+    parser = argparse.ArgumentParser(
+        description="Keep the cropping pipeline warm in worker processes and run pdfcropper.py and numbering.py jobs sent over HTTP, or send jobs to a running service"
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        required=False,
+        help="address the service listens on, default is 127.0.0.1 (this machine only), there is no authentication so do not expose it to untrusted networks",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        required=False,
+        help="port the service listens on, default is 8765",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        required=False,
+        help="number of worker processes, i.e. of jobs running at the same time, each keeps cv2, numpy, PIL and pdfplumber imported between jobs, default is 2",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=1000,
+        required=False,
+        help="number of finished jobs whose status is kept for querying, default is 1000",
+    )
+    parser.add_argument(
+        "--quiet",
+        type=lambda x: (str(x).lower() == "true"),
+        default=False,
+        required=False,
+        help="if true, do not log every request, default is false",
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        default="http://127.0.0.1:8765",
+        required=False,
+        help="url of a running service, for --submit and --status",
+    )
+    parser.add_argument(
+        "--submit",
+        type=str,
+        default=None,
+        required=False,
+        help='send a job to a running service instead of serving, as json: {"kind": "crop" or "number", "args": {...}}, args are the options of pdfcropper.py or numbering.py without the leading dashes, e.g. {"kind": "crop", "args": {"src_path": "../test/test.pdf", "dst_path": "../output", "dpi": 300}}. Paths are relative to the folder the service was started in',
+    )
+    parser.add_argument(
+        "--status",
+        type=str,
+        default=None,
+        required=False,
+        help="print the status of a job of a running service by its id",
+    )
+    parser.add_argument(
+        "--wait",
+        type=lambda x: (str(x).lower() == "true"),
+        default=False,
+        required=False,
+        help="if true, with --submit or --status, wait until the job is done or failed, and exit with 1 if it failed",
+    )
+
+    args = parser.parse_args()
+    if args.submit is None and args.status is None:
+        serve(args.host, args.port, args.workers, args.history, args.quiet)
+        sys.exit(0)
+    try:
+        if args.submit is not None:
+            status = submit_job(args.url, json.loads(args.submit))
+        else:
+            status = get_job(args.url, args.status)
+        if args.wait:
+            status = wait_job(args.url, status["id"])
+    except (ValueError, OSError) as e:  # rejected jobs, and services not reachable
+        print(f"Request failed: {e}")
+        sys.exit(1)
+    print(json.dumps(status, ensure_ascii=False, indent=1))
+    sys.exit(1 if status["status"] == "failed" else 0)
@@ -0,0 +1,37 @@
+import os, sys
+import argparse
+
+# import local modules
+sys.path.append("..")
+from modules.shard import merge_manifests
+
+
+if __name__ == "__main__":
+    # Usage example: python merge_shards.py --src_paths "../output-1" "../output-2" --dst_path="../output"
+    parser = argparse.ArgumentParser(
+        description="Combine the outputs of a pdf parsed in shards (pdfcropper.py --shard k/N) into a single output folder"
+    )
+    parser.add_argument(
+        "--src_paths",
+        type=str,
+        nargs="+",
+        required=True,
+        help="output folders of the shards (or their manifest-k-of-N.json files), can be the same folder if all the shards wrote into it",
+    )
+    parser.add_argument(
+        "--dst_path",
+        type=str,
+        required=True,
+        help="path to the merged output folder, the files of the shards written elsewhere are copied into it, and a manifest.json listing every page is written",
+    )
+
+    args = parser.parse_args()
+    try:
+        merged = merge_manifests(args.src_paths, args.dst_path)
+    except ValueError as e:
+        print(f"Merging failed: {e}")
+        sys.exit(1)
+    n_files = sum(len(entry["files"]) for entry in merged["entries"])
+    print(
+        f"Merged {merged['shards']} shard(s) of {merged['source']}: {len(merged['entries'])} pages, {n_files} files"
+    )
@@ -1,77 +1,110 @@
-from PIL import Image
-from math import *
-import pdfplumber
 import os, sys
+import json
 import argparse
-from tqdm import tqdm
 
+# numpy, PIL and pdfplumber are imported by the functions using them, so that --help starts quickly and the service can import this script cheaply
 sys.path.append("..")
 
+# the extensions of the output formats of pdfcropper
+BONE_EXTENSIONS = (".png", ".webp", ".tif")
+
+
+def parse_bone_name(file_name):
+    """
+    description:
+      parse the page number and the bounding box out of a "{page}-[x, y, w, h].png" (or .webp, .tif) file name saved by pdfcropper
+    returns:
+      (page number, [x, y, w, h]), or None if the file is not an unnumbered bone image
+    """
+    stem, ext = os.path.splitext(file_name)
+    page, _, box = stem.partition("-")
+    if ext not in BONE_EXTENSIONS:
+        return None
+    try:
+        page, box = int(page), json.loads(box)
+    except ValueError:
+        return None
+    if not isinstance(box, list) or len(box) != 4:
+        return None
+    return page, box
+
+
+def group_bones(src_bones):
+    """
+    description:
+      list the bone folder once and group the bone files by page number
+    returns:
+      dict, page number -> list of (file name, box), in file name order
+    """
+    bones = {}
+    for file_name in sorted(os.listdir(src_bones)):
+        parsed = parse_bone_name(file_name)
+        if parsed is not None:
+            bones.setdefault(parsed[0], []).append((file_name, parsed[1]))
+    return bones
+
 
 def assign_numbers(src_bones, src_pages, ocr_path, start_page=1, x_tolerance=8):
-    bone_files = os.listdir(src_bones)
+    """
+    description:
+      rename the bone files of every page after the number closest to them in the text layer of the ocr pdf
+    returns:
+      int, the number of bones renamed
+    """
+    import pdfplumber
+    from PIL import Image
+    from tqdm import tqdm
+    from modules.labels import label_names, page_words
+
+    renamed = 0
+    bones = group_bones(src_bones)
     with pdfplumber.open(ocr_path) as pdf:
         for i, page in enumerate(tqdm(pdf.pages)):
-            page_width = page.width
-            page_height = page.height
-            page_path = os.path.join(src_pages, f"{i+start_page}.png")
+            # get the correct bones with the same page number
+            correct_page_num = i + start_page
+            bone_files = bones.get(correct_page_num, [])
+            if len(bone_files) == 0:
+                page.close()
+                continue
+            # the page is saved in the same format as its bones
+            ext = os.path.splitext(bone_files[0][0])[1]
+            page_path = os.path.join(src_pages, f"{correct_page_num}{ext}")
             page_dimensions = Image.open(page_path).size
-            # normalize the ratio discrepancy caused by DPI difference
-            aver_ratio = (
-                page_dimensions[0] / page_width + page_dimensions[1] / page_height
-            ) / 2
             # extract words, can set a higher x_tolerance to merge adjcant numbers if there is problems
-            words = page.extract_words(x_tolerance=x_tolerance)
-            # number text, there might be useless text like "典宾"、"宾一" which does not matter
-            texts = [word["text"] for word in words]
-            center_points = [
-                (
-                    (word["x0"] + word["x1"]) / 2 * aver_ratio,
-                    (word["top"] + word["bottom"]) / 2 * aver_ratio,
+            words = page_words(page, x_tolerance)
+            # assign the numbers to the bones, the same names as pdfcropper gives with --src_ocr, path separators in the text included
+            labels = label_names([box for _, box in bone_files], words, page_dimensions)
+            for (bone_path, box), label in zip(bone_files, labels):
+                if label is None:
+                    print(
+                        f"No number left for {bone_path}, or its number is taken by another bone of the page, please check manually."
+                    )
+                    continue
+                target = os.path.join(
+                    src_bones,
+                    f"{correct_page_num}-{label}{os.path.splitext(bone_path)[1]}",
                 )
-                for word in words
-            ]
-            # get the bounding boxes of the bones from the image dir
-            # get the correct bones with the same page number
-            correct_page_num = i + start_page
-            bone_paths = [
-                path
-                for path in bone_files
-                if int(path.split("-")[0]) == correct_page_num
-            ]
-            # assign the numbers to the bones by renaming the files
-            for bone_path in bone_paths:
-                box = eval(
-                    bone_path.split("-")[1].replace(".png", "")
-                )  # bounding box list [x, y, w, h]
-                # get the closest text to it by calculating the distance between the center of the text to the bottom center of the box (as the text is always at the exact bottom or near bottom)
-                distances = [
-                    sqrt(
-                        (center[0] - (box[0] + box[2] / 2)) ** 2
-                        + (center[1] - (box[1] + box[3])) ** 2
+                # rename the bone file with the closest text, never overwrite an existing one
+                if os.path.exists(target):
+                    print(
+                        f"Error in renaming {bone_path}, multiple bones are assigned to this number, please check manually afterwards."
                     )
-                    for center in center_points
-                ]
-                closest_text = texts[distances.index(min(distances))]
-                # rename the bone file with the closest text
+                    continue
                 try:
-                    os.rename(
-                        os.path.join(src_bones, bone_path),
-                        os.path.join(
-                            src_bones, f"{correct_page_num}-{closest_text}.png"
-                        ),
-                    )
-                except:
+                    os.rename(os.path.join(src_bones, bone_path), target)
+                except OSError as e:
+                    # e.g. a number which is not a valid file name, the other bones are still renamed
                     print(
-                        f"Error in renaming {bone_path}, multiple bones are assigned to this number, please check manually afterwards."
+                        f"Error in renaming {bone_path} to {os.path.basename(target)}: {e}, please check manually afterwards."
                     )
-                    # skip rename
                     continue
+                renamed += 1
             page.close()  # release memory
+    return renamed
 
 
-if __name__ == "__main__":
-    # Usage example: python numbering.py --src_bones="..\output\bones" --src_pages="..\output\pages" --src_ocr="..\output\ocr.pdf" --x_tolerance=8 --start_page=1
+def build_parser():
+    # the command line options, shared with the jobs of cropper_service.py
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--src_bones",
@@ -105,7 +138,16 @@ if __name__ == "__main__":
         help="x tolerance for merging adjacent numbers, set a higher value if some numbers are not merged into a single one",
     )
 
-    args = parser.parse_args()
-    assign_numbers(
+    return parser
+
+
+def main(args):
+    # run assign_numbers with the options parsed by build_parser, returns the number of bones renamed
+    return assign_numbers(
         args.src_bones, args.src_pages, args.src_ocr, args.start_page, args.x_tolerance
     )
+
+
+if __name__ == "__main__":
+    # Usage example: python numbering.py --src_bones="..\output\bones" --src_pages="..\output\pages" --src_ocr="..\output\ocr.pdf" --x_tolerance=8 --start_page=1
+    main(build_parser().parse_args())
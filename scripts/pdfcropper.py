@@ -1,15 +1,533 @@
-from math import *
-from PIL import Image
-import numpy as np
 import os, sys
-import pdfplumber
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import argparse
-from tqdm import tqdm
 
-# import local modules
+# import local modules, the heavy ones (cv2, numpy, PIL, pdfplumber) are imported by the functions using them, so that --help starts quickly and the service can import this script cheaply
 sys.path.append("..")
-from modules.cropper import RubbingCropper
+from modules.metrics import PageMetrics, MetricsSink, timed
+from modules.journal import ProgressJournal, partial_tag
+from modules.pack import PACK_FORMATS, build_index, pack_prefix, write_index
+from modules.shard import (
+    Manifest,
+    detection_name,
+    list_hash,
+    parse_page_list,
+    parse_shard,
+    shard_items,
+)
+
+
+# the pdf handle opened by each worker process of the pool, see _init_worker
+_worker_pdf = None
+# the image writer of the current process, and its exit hook, see get_writer
+_writer = None
+_writer_finalizer = None
+# the ocr pdf of the current process, (path, pdfplumber.PDF), see get_ocr_pdf
+_ocr_pdf = None
+
+
+def get_writer(
+    save_path,
+    only_object,
+    dpi,
+    fmt,
+    compress_level,
+    writer_threads,
+    pack=None,
+    pack_size=1024,
+    shard=(1, 1),
+    subfolders=None,
+):
+    """
+    description:
+      the image writer of the current process, created on first use, so that its output folders are created once per process and its threads are shared by all the pages
+    args:
+      pack, pack_size, shard: optional container format ("tar" or "zip") the objects are packed into, the size of the containers in MB, and the shard of the run, see PackWriter
+      subfolders: tuple, optional subfolders written to, images (and pages unless only_object) by default
+    """
+    from multiprocessing.util import Finalize
+    from modules.writer import ImageWriter
+    from modules.pack import PackWriter
+
+    global _writer, _writer_finalizer
+    if _writer is None:
+        if subfolders is None:
+            subfolders = ("images",) if only_object else ("images", "pages")
+        if pack is not None:
+            subfolders = tuple(s for s in subfolders if s != "images")
+            pack = PackWriter(save_path, pack, pack_size << 20, pack_prefix(shard))
+        _writer = ImageWriter(
+            save_path,
+            subfolders,
+            fmt,
+            compress_level,
+            dpi,
+            writer_threads,
+            pack=pack,
+            tag=partial_tag(shard),
+        )
+    if _writer_finalizer is None:
+        # worker processes exit without returning to parse_pages, their writer (and the containers of a packed output) is closed when they exit
+        _writer_finalizer = Finalize(None, close_writer, exitpriority=10)
+    return _writer
+
+
+def close_writer():
+    # wait for the pending images of the current process and release the writer
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def get_ocr_pdf(path):
+    # the ocr pdf labelling the pages, opened once per process, as the pdf of the workers
+    import pdfplumber
+
+    global _ocr_pdf
+    if _ocr_pdf is None or _ocr_pdf[0] != path:
+        close_ocr_pdf()
+        _ocr_pdf = (path, pdfplumber.open(path))
+    return _ocr_pdf[1]
+
+
+def close_ocr_pdf():
+    global _ocr_pdf
+    if _ocr_pdf is not None:
+        _ocr_pdf[1].close()
+        _ocr_pdf = None
+
+
+def read_page_words(pdf, index, src_ocr, ocr_start_page=1, x_tolerance=8):
+    """
+    description:
+      the words labelling a page, read from its own text layer or from the matching page of the ocr pdf
+    args:
+      src_ocr: str, "source" for the text layer of the pdf itself, otherwise path to the ocr pdf
+      ocr_start_page: int, page number in the source pdf of the first page of the ocr pdf
+    returns:
+      see page_words, None if the ocr pdf has no page for it
+    """
+    from modules.labels import page_words
+
+    if src_ocr == "source":
+        return page_words(pdf.pages[index], x_tolerance)
+    ocr = get_ocr_pdf(src_ocr)
+    ocr_index = index + 1 - ocr_start_page
+    if not 0 <= ocr_index < len(ocr.pages):
+        return None
+    page = ocr.pages[ocr_index]
+    words = page_words(page, x_tolerance)
+    page.close()  # release memory
+    return words
+
+
+def save_output(
+    output, writer, name, only_object, dpi=None, labels=None, contours=None
+):
+    """
+    description:
+      queue the cropped objects (and optionally the whitened page, once) of a single page or image to the writer
+    args:
+      output: dict, the output of RubbingCropper or TiledCropper, whose images are generated one at a time
+      writer: ImageWriter
+      name: str, page number or image basename used as the prefix of the saved files
+      dpi: int, optional resolution of the page, if not the one of the writer
+      labels: list, optional number of every object, see label_names, the objects with a number are saved as "{name}-{number}" right away, the others keep their box
+      contours: list, optional outline of every object, stored with its box in the index of a packed output, see PackWriter
+    returns:
+      list of Future, one per file, see finish_page
+    """
+    writes = []
+    for j, bone in enumerate(output["images"]):
+        box = output["boxes"][j]
+        label = labels[j] if labels is not None else None
+        meta = None
+        if writer.pack is not None:
+            meta = {"page": name, "object": j, "box": [int(v) for v in box]}
+            if contours is not None:
+                meta["polygon"] = contours[j].reshape(-1, 2).tolist()
+        # save the bone tracings
+        writes.append(
+            writer.submit(
+                "images",
+                f"{name}-{label if label is not None else [box[0], box[1], box[2], box[3]]}",
+                bone,
+                dpi,
+                meta,
+            )
+        )
+    # save the page with bone tracings replaced by white background
+    if not only_object and len(output["boxes"]) > 0:
+        writes.append(writer.submit("pages", f"{name}", output["page"], dpi))
+    return writes
+
+
+def save_detection(
+    cropper, writer, name, page, overlay_size, dpi=None, labels=None, n_contours=None
+):
+    """
+    description:
+      the detection of a single page or image in detect_only mode, and optionally its overlay thumbnail queued to the writer as overlays/{name}
+    args:
+      cropper: RubbingCropper or TiledCropper, run with nothing cropped or whitened
+      page: numpy array or PIL Image, the page the objects were detected on
+      overlay_size: int, the longest side of the overlay in pixels, 0 for none
+      dpi, labels, n_contours: see detection_record
+    returns:
+      (writes, detection), see finish_page
+    """
+    from modules.preview import detection_record, draw_overlay
+
+    # (width, height) of an ndarray or of a PIL Image
+    size = (page.shape[1], page.shape[0]) if hasattr(page, "shape") else page.size
+    detection = detection_record(cropper.contours, size, dpi, labels, n_contours)
+    writes = []
+    if overlay_size:
+        overlay = draw_overlay(
+            page, detection["boxes"], detection["polygons"], overlay_size
+        )
+        writes.append(writer.submit("overlays", f"{name}", overlay))
+    return writes, detection
+
+
+def finish_page(page, record, writes, detection=None):
+    """
+    description:
+      wait for the files of a page to be written, raising the first error if any
+    args:
+      detection: dict, optional detection of the page in detect_only mode, see save_detection
+    returns:
+      (entry, record), the manifest entry of the page, with its detection if any, and its metrics record completed with the time spent saving and the bytes written, None if not instrumented
+    """
+    entry = {"page": page, "files": []}
+    for write in writes:
+        file, seconds, size = write.result()
+        if file not in entry["files"]:  # packed objects share their container
+            entry["files"].append(file)
+        if record is not None:
+            record["timings"]["save"] = record["timings"].get("save", 0) + seconds
+            counters = record["counters"]
+            counters["files_written"] = counters.get("files_written", 0) + 1
+            counters["bytes_written"] = counters.get("bytes_written", 0) + size
+    if detection is not None:
+        entry["detection"] = detection
+    return entry, record
+
+
+def finish_in_order(results, lookahead=1):
+    """
+    description:
+      finish the pages of the current process in order, while the files of a page are written, the next lookahead pages are already processed
+    """
+    pending = deque()
+    for result in results:
+        pending.append(result)
+        if len(pending) > lookahead:
+            yield finish_page(*pending.popleft())
+    while pending:
+        yield finish_page(*pending.popleft())
+
+
+def crop_pdf_page(
+    pdf,
+    index,
+    save_path,
+    mode,
+    padding,
+    dpi,
+    text_threshold,
+    only_object,
+    detect_scale=1,
+    cache=None,
+    pdf_hash=None,
+    instrument=False,
+    fmt="png",
+    compress_level=6,
+    writer_threads=2,
+    backend="raster",
+    src_ocr=None,
+    ocr_start_page=1,
+    x_tolerance=8,
+    pack=None,
+    pack_size=1024,
+    shard=(1, 1),
+    bilevel=False,
+    detect_only=False,
+    overlay_size=0,
+):
+    """
+    description:
+      render, crop and save a single page of an opened pdf, shared by the serial loop and the worker processes
+    args:
+      pdf: pdfplumber.PDF, the opened pdf
+      index: int, 0-based index of the page
+      detect_scale: float, detection scale, see RubbingCropper
+      cache: PageCache, optional cache of rendered pages and detection results, pdf_hash is required with it
+      instrument: bool, whether to collect the timings and counters of the page
+      fmt, compress_level, writer_threads: output format, its compression level and the number of encoding threads, see ImageWriter
+      backend: str, "raster" or "embedded", see render_page
+      src_ocr, ocr_start_page, x_tolerance: optional source of the number labels of the objects, see read_page_words, the objects are saved under their number right away
+      pack, pack_size, shard: optional packed output of the objects, see get_writer
+      bilevel: bool or "auto", see RubbingCropper
+      detect_only, overlay_size: only detect the objects of the page, and optionally write its overlay thumbnail, see save_detection
+    returns:
+      (page, record, writes, detection), the page number, the metrics record of the page if instrumented, otherwise None, the pending writes of the page, and its detection in detect_only mode, otherwise None, see finish_page
+    """
+    from modules.cropper import RubbingCropper, KERNEL_SIZE
+    from modules.render import render_page
+    from modules.labels import label_names
+
+    page_num = index + 1
+    metrics = PageMetrics(page_num) if instrument else None
+    img, detection = None, None
+    page_dpi = dpi
+    if cache is not None:
+        # embedded images are cached apart, the fallback pages still depend on the dpi
+        page_key = cache.page_key(
+            pdf_hash, page_num, dpi if backend == "raster" else f"{backend}{dpi}"
+        )
+        detection_key = cache.detection_key(
+            page_key, kernel=KERNEL_SIZE, scale=detect_scale
+        )
+        with timed(metrics, "cache_load"):
+            img = cache.load_page(page_key)
+            detection = cache.load_detection(detection_key)
+    if img is None:
+        with timed(metrics, "render"):
+            img, page_dpi, embedded = render_page(pdf.pages[index], dpi, backend)
+        if metrics is not None and embedded:
+            metrics.count("embedded")
+        if cache is not None:
+            with timed(metrics, "cache_save"):
+                cache.save_page(page_key, img)
+    elif backend != "raster":
+        page_dpi = round(img.shape[1] * 72 / float(pdf.pages[index].width))
+    words = None
+    if src_ocr is not None:
+        # read while the page is open, the text layer of the source is parsed once with the page
+        with timed(metrics, "labels"):
+            words = read_page_words(pdf, index, src_ocr, ocr_start_page, x_tolerance)
+    pdf.pages[index].close()  # release memory
+    # get all the bone tracings and page with bone tracings replaced by white background, see other file for details of the class
+    cropper = RubbingCropper(
+        img,
+        text_threshold,
+        mode=mode,
+        padding=padding,
+        detection=detection,
+        detect_scale=detect_scale,
+        metrics=metrics,
+        bilevel=bilevel,
+        detect_only=detect_only,
+        # selected as the RGB pages of pdfplumber, also the gray and bilevel embedded scans, which are not expanded to RGB
+        color=True,
+    )
+    if cache is not None and detection is None:
+        with timed(metrics, "cache_save"):
+            cache.save_detection(detection_key, cropper.detection)
+    labels = None
+    if words is not None:
+        with timed(metrics, "labels"):
+            height, width = cropper.original.shape[:2]
+            labels = label_names(cropper.output["boxes"], words, (width, height))
+        for box, label in zip(cropper.output["boxes"], labels):
+            if label is None and not detect_only:
+                print(
+                    f"No number for {page_num}-{list(box)}, saved under its box, please check manually."
+                )
+        if metrics is not None:
+            metrics.count("labelled", sum(label is not None for label in labels))
+    writer = get_writer(
+        save_path,
+        only_object,
+        dpi,
+        fmt,
+        compress_level,
+        writer_threads,
+        pack,
+        pack_size,
+        shard,
+        (("overlays",) if overlay_size else ()) if detect_only else None,
+    )
+    if detect_only:
+        with timed(metrics, "queue"):
+            writes, detection = save_detection(
+                cropper,
+                writer,
+                page_num,
+                cropper.gray,
+                overlay_size,
+                page_dpi,
+                labels,
+                len(cropper.detection[0]),
+            )
+        return (
+            page_num,
+            (metrics.to_dict() if metrics is not None else None),
+            writes,
+            detection,
+        )
+    with timed(metrics, "queue"):
+        writes = save_output(
+            cropper.output,
+            writer,
+            page_num,
+            only_object,
+            page_dpi,
+            labels,
+            cropper.contours,
+        )
+    return page_num, (metrics.to_dict() if metrics is not None else None), writes, None
+
+
+def crop_image(
+    img_path,
+    save_path,
+    mode,
+    padding,
+    dpi,
+    text_threshold,
+    only_object,
+    detect_scale=1,
+    instrument=False,
+    fmt="png",
+    compress_level=6,
+    writer_threads=2,
+    memory_budget=None,
+    tile_threads=2,
+    pack=None,
+    pack_size=1024,
+    shard=(1, 1),
+    bilevel=False,
+    detect_only=False,
+    overlay_size=0,
+):
+    """
+    description:
+      crop and save a single image file, shared by the serial loop and the worker processes. Images too large for the memory budget are processed by bands with TiledCropper, which writes 8-bit images whatever bilevel is
+    returns:
+      (name, record, writes, detection), see crop_pdf_page
+    """
+    from modules.cropper import RubbingCropper
+    from modules.tiled import TiledCropper, needs_tiling
+
+    name = os.path.basename(img_path).split(".")[0]
+    metrics = PageMetrics(name) if instrument else None
+    writer = get_writer(
+        save_path,
+        only_object,
+        dpi,
+        fmt,
+        compress_level,
+        writer_threads,
+        pack,
+        pack_size,
+        shard,
+        (("overlays",) if overlay_size else ()) if detect_only else None,
+    )
+    if memory_budget and needs_tiling(img_path, memory_budget):
+        # detect_scale is not used here, the bands are already bounded by the budget
+        cropper = TiledCropper(
+            img_path,
+            text_threshold,
+            mode=mode,
+            padding=padding,
+            memory_mb=memory_budget,
+            threads=tile_threads,
+            metrics=metrics,
+        )
+        detection = None
+        try:
+            with timed(metrics, "queue"):
+                if detect_only:
+                    # nothing is cropped as long as the images of the output are not consumed
+                    writes, detection = save_detection(
+                        cropper, writer, name, cropper.output["page"], overlay_size
+                    )
+                else:
+                    writes = save_output(
+                        cropper.output,
+                        writer,
+                        name,
+                        only_object,
+                        contours=cropper.contours,
+                    )
+            # the page is read from the scratch files of the cropper, which are removed once written
+            for write in writes:
+                write.result()
+        finally:
+            cropper.close()
+        if metrics is not None:
+            metrics.count("tiled")
+        return (
+            name,
+            (metrics.to_dict() if metrics is not None else None),
+            writes,
+            detection,
+        )
+    # get all the bone tracings and page with bone tracings replaced by white background, see other file for details of the class
+    cropper = RubbingCropper(
+        img_path,
+        text_threshold,
+        mode=mode,
+        padding=padding,
+        detect_scale=detect_scale,
+        metrics=metrics,
+        bilevel=bilevel,
+        detect_only=detect_only,
+    )
+    detection = None
+    with timed(metrics, "queue"):
+        if detect_only:
+            writes, detection = save_detection(
+                cropper,
+                writer,
+                name,
+                cropper.gray,
+                overlay_size,
+                n_contours=len(cropper.detection[0]),
+            )
+        else:
+            writes = save_output(
+                cropper.output, writer, name, only_object, contours=cropper.contours
+            )
+    return name, (metrics.to_dict() if metrics is not None else None), writes, detection
+
+
+def _init_worker(src_path):
+    # every worker opens the pdf by itself, so that neither pdfplumber objects nor page bitmaps are pickled between processes
+    import pdfplumber
+
+    global _worker_pdf
+    _worker_pdf = pdfplumber.open(src_path)
+
+
+def _crop_pdf_page_worker(index, **options):
+    # the page is finished in the worker, so that only the small manifest entry and metrics record go back to the main process
+    return finish_page(*crop_pdf_page(_worker_pdf, index, **options))
+
+
+def _crop_image_worker(img_path, **options):
+    return finish_page(*crop_image(img_path, **options))
+
+
+def ordered_map(executor, fn, items, options, window):
+    """
+    description:
+      submit fn(item, **options) to the executor for every item, and yield the results in the order of the items
+    args:
+      window: int, the maximum number of tasks in flight, bounding the memory held by pending pages
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item, **options))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def parse_pdf(
@@ -22,6 +540,29 @@ def parse_pdf(
     dpi=600,
     text_threshold=(200, 100),
     only_object=True,
+    workers=1,
+    cache_dir=None,
+    cache_size=(48, 1),
+    detect_scale=1,
+    metrics_path=None,
+    on_metrics=None,
+    fmt="png",
+    compress_level=6,
+    writer_threads=2,
+    pages=None,
+    shard=(1, 1),
+    resume=False,
+    backend="raster",
+    memory_budget=None,
+    tile_threads=2,
+    src_ocr=None,
+    ocr_start_page=1,
+    x_tolerance=8,
+    pack=None,
+    pack_size=1024,
+    bilevel=False,
+    detect_only=False,
+    overlay_size=0,
 ):
     """
     description:
@@ -29,115 +570,311 @@ def parse_pdf(
     args:
       src_path: str, path to pdf file or folder containing images to be parsed.
       save_path: str, path to the output folder, the folder will be created if not exist.
-      exclude_range: list, list of page numbers to exclude from parsing.
+      start_page, end_page: int, 1-based inclusive page range of a pdf, -1 for the last page, ignored if pages is given.
+      pages: str, page selection of a pdf like "1-40,55,90-", see parse_page_list.
+      shard: tuple, (k, N), only process the k-th of N shards of the selected pages (or of the sorted images of a folder), see shard_items. Every shard writes its own manifest, combine them with merge_shards.py.
+      resume: bool, skip the pages completed by a previous run into save_path with the same input and options, as recorded in its progress journal, and redo the others.
       dpi: int, resolution of the image to be saved.
+      backend: str, "raster" renders every page of a pdf at dpi, "embedded" takes the scan embedded in single image pages at its native resolution instead, and renders the other pages, see render_page.
+      workers: int, number of worker processes for rendering, cropping and saving, 1 to process everything in the current process.
+      cache_dir: str, optional folder caching rendered pages and detection results between runs over the same pdf.
+      cache_size: tuple, (float, float), size budget of the cached pages and detection results in GB.
+      detect_scale: float, run the detection on pages shrunk by this scale, e.g. 0.25, crops are still taken from the full resolution pages.
+      metrics_path: str, optional jsonl file, one record of per-stage timings, contour counts, bytes written and peak memory is appended per page.
+      on_metrics: callable, optional hook called with the same record (a dict) of every page, in page order.
+      fmt: str, output format, "png", "webp" (lossless) or "tiff" (deflate compressed).
+      compress_level: int, 0-9, compression level of the output, zlib level for png, effort for webp.
+      writer_threads: int, number of threads encoding and writing the output of each process, while the next page is processed.
+      memory_budget: int, optional memory budget in MB per process for image files, images which would not fit in it whole are processed by bands of rows with scratch files on disk, see TiledCropper. None or 0 processes every image whole.
+      tile_threads: int, number of threads processing the bands of an image in the tiled mode.
+      src_ocr: str, optional, number the objects of a pdf while cropping, by the words of its own text layer ("source") or of an ocr pdf (its path), every object is then saved once under its number, as numbering.py would rename it.
+      ocr_start_page: int, page number in the source pdf of the first page of the ocr pdf.
+      x_tolerance: int, x tolerance for merging adjacent characters of a number, see page_words.
+      pack: str, optional, "tar" or "zip", pack the objects into containers of about pack_size MB instead of writing one file each, with an index.jsonl (index-k-of-N.jsonl for a shard) of the page, box, polygon, dpi and byte offsets of every object, read them with PackReader. Pages are still written as files.
+      pack_size: int, size in MB of the containers.
+      detect_only: bool, only detect the objects, without cropping, whitening or writing them, the boxes and simplified polygons of every page are written to detections.jsonl (detections-k-of-N.jsonl for a shard) instead, for tuning the options at a fraction of the cost of a full run. pack is ignored.
+      overlay_size: int, with detect_only, write a thumbnail of every page with its boxes and polygons drawn over it into the overlays folder, of this size in pixels (its longest side), 0 for none.
+      bilevel: bool or "auto", write the objects and pages of two-tone pages ("auto"), or of every page thresholded into black and white (True), as 1-bit images, see RubbingCropper.
+    returns:
+      dict, the manifest of the run (source, options and the files written for every page), None if the input path is invalid
     """
-    if os.path.isfile(src_path) and src_path.endswith(".pdf"):
-        with pdfplumber.open(src_path) as pdf:
-            print(f"Processing begins for {len(pdf.pages)} pages...")
-            for i, page in enumerate(tqdm(pdf.pages)):
-                if i < start_page - 1:
-                    print(f"page {start_page} excluded, continue...")
-                    continue
-                if end_page != -1 and i >= end_page:
-                    print(f"specified end page {end_page} reached, stop processing...")
-                    break
-                page_num = page.page_number
-                img = page.to_image(
-                    resolution=dpi, antialias=True
-                )  # abbyy finereader image conversion use a 600dpi, consider chaning this if needed
-                page.close()  # release memory
-                # get all the bone tracings and page with bone tracings replaced by white background, see other file for details of the class
-                output = RubbingCropper(
-                    img.original, text_threshold, mode=mode, padding=padding
-                ).output
-                for j, bone in enumerate(output["images"]):
-                    box = output["boxes"][j]
-                    save_name = f"{page_num}-{[box[0], box[1], box[2], box[3]]}.png"
-                    if not os.path.exists(save_path):
-                        os.makedirs(save_path)
-                    if not os.path.exists(os.path.join(save_path, "images")):
-                        os.makedirs(os.path.join(save_path, "images"))
-                    if not only_object and not os.path.exists(
-                        os.path.join(save_path, "pages")
-                    ):
-                        os.makedirs(os.path.join(save_path, "pages"))
-                    # save the bone tracings
-                    Image.fromarray(bone).save(
-                        os.path.join(save_path, "images", save_name), dpi=(dpi, dpi)
-                    )
-                    # save the page with bone tracings replaced by white background
-                    if not only_object:
-                        Image.fromarray(output["page"]).save(
-                            os.path.join(save_path, "pages", f"{page_num}.png"),
-                            dpi=(dpi, dpi),
-                        )
-            print(f"Processing finished!")
-    else:
-        # if is file and ends with image extension
-        if os.path.isfile(src_path) and (
-            src_path.endswith(".png")
-            or src_path.endswith(".jpg")
-            or src_path.endswith(".jpeg")
-            or src_path.endswith(".tif")
-            or src_path.endswith(".tiff")
-            or src_path.endswith(".bmp")
-            or src_path.endswith(".webp")
-        ):
-            images = [src_path]
-        elif os.path.isdir(src_path):
-            # get all the images in the folder
-            images = [
-                os.path.join(src_path, f)
-                for f in os.listdir(src_path)
-                if f.endswith(".png")
-                or f.endswith(".jpg")
-                or f.endswith(".jpeg")
-                or f.endswith(".tif")
-                or f.endswith(".tiff")
-                or f.endswith(".bmp")
-                or f.endswith(".webp")
+    from modules.cache import PageCache, file_hash
+
+    if detect_only:
+        pack = None  # nothing to pack
+    if pack is not None and pack not in PACK_FORMATS:
+        raise ValueError(f"Invalid pack format {pack}, must be one of {list(PACK_FORMATS)}")
+    if bilevel not in (True, False, "auto"):
+        raise ValueError(f'Invalid bilevel {bilevel!r}, must be True, False or "auto"')
+    options = dict(
+        save_path=save_path,
+        mode=mode,
+        padding=padding,
+        dpi=dpi,
+        text_threshold=text_threshold,
+        only_object=only_object,
+        detect_scale=detect_scale,
+        instrument=metrics_path is not None or on_metrics is not None,
+        fmt=fmt,
+        compress_level=compress_level,
+        writer_threads=writer_threads,
+        pack=pack,
+        pack_size=pack_size,
+        shard=shard,
+        bilevel=bilevel,
+        detect_only=detect_only,
+        overlay_size=overlay_size,
+    )
+    # the options changing the output, shards can only be merged if they agree on them
+    output_options = dict(
+        mode=mode,
+        padding=padding,
+        dpi=dpi,
+        text_threshold=list(text_threshold),
+        only_object=only_object,
+        detect_scale=detect_scale,
+        fmt=fmt,
+        compress_level=compress_level,
+    )
+    if pack is not None:
+        output_options["pack"] = pack
+    if bilevel:
+        output_options["bilevel"] = bilevel
+    if detect_only:
+        output_options.update(detect_only=True, overlay_size=overlay_size)
+    with MetricsSink(metrics_path, on_metrics) as report:
+        if os.path.isfile(src_path) and src_path.endswith(".pdf"):
+            if pages is None:
+                pages = f"{start_page}-{'' if end_page == -1 else end_page}"
+            pdf_hash = file_hash(src_path)
+            if cache_dir is not None:
+                cache = PageCache(
+                    cache_dir,
+                    int(cache_size[0] * (1 << 30)),
+                    int(cache_size[1] * (1 << 30)),
+                )
+                options.update(cache=cache, pdf_hash=pdf_hash)
+            options["backend"] = backend
+            output_options.update(pages=pages, backend=backend)
+            if src_ocr is not None:
+                if src_ocr != "source" and not os.path.isfile(src_ocr):
+                    print(f"Invalid ocr path {src_ocr}, the path should be a pdf.")
+                    return
+                options.update(
+                    src_ocr=src_ocr if src_ocr == "source" else os.path.abspath(src_ocr),
+                    ocr_start_page=ocr_start_page,
+                    x_tolerance=x_tolerance,
+                )
+                output_options["labels"] = dict(
+                    src_ocr=os.path.basename(src_ocr),
+                    ocr_start_page=ocr_start_page,
+                    x_tolerance=x_tolerance,
+                )
+            # the selection is checked before the journal is opened, an invalid one must not truncate the journal of a previous run
+            selected = select_pages(src_path, pages, shard)
+            manifest = Manifest(
+                save_path, os.path.basename(src_path), pdf_hash, shard, output_options
+            )
+            with start_journal(manifest, save_path, shard, resume) as journal:
+                parse_pages(
+                    src_path, selected, workers, options, report, manifest, journal
+                )
+        else:
+            if src_ocr is not None:
+                print(
+                    "Numbering while cropping (src_ocr) is only supported for pdf input, use numbering.py."
+                )
+                return
+            images = list_images(src_path)
+            if images is None:
+                print(
+                    "Invalid input path, the path should be a pdf or an image or a folder containing images."
+                )
+                return
+            manifest = Manifest(
+                save_path,
+                os.path.basename(os.path.normpath(src_path)),
+                list_hash([os.path.basename(f) for f in images]),
+                shard,
+                output_options,
+            )
+            images = shard_items(images, shard)
+            with start_journal(manifest, save_path, shard, resume) as journal:
+                options.update(memory_budget=memory_budget, tile_threads=tile_threads)
+                parse_images(images, workers, options, report, manifest, journal)
+        if pack is not None:
+            # the containers of every process are complete, their partial indexes are merged
+            build_index(save_path, manifest.data["entries"], shard)
+        if detect_only:
+            # the detections are kept in the progress journal for resuming, and written apart from the manifest
+            detections = [
+                dict(page=entry["page"], **entry.pop("detection"))
+                for entry in sorted(manifest.data["entries"], key=lambda e: e["page"])
             ]
+            write_index(os.path.join(save_path, detection_name(shard)), detections)
+        manifest.write()
+    return manifest.data
+
+
+def start_journal(manifest, save_path, shard, resume):
+    """
+    description:
+      open the progress journal of a run, the pages completed by the resumed run go into the manifest right away
+    returns:
+      ProgressJournal, the pages in its done attribute are to be skipped
+    """
+    journal = ProgressJournal(save_path, manifest.header(), shard, resume)
+    for entry in journal.done.values():
+        manifest.add(entry)
+    if journal.done:
+        print(f"Resuming, {len(journal.done)} completed page(s) skipped")
+    return journal
+
+
+def select_pages(src_path, pages, shard):
+    """
+    description:
+      the page numbers of a pdf processed by a run, raises ValueError for an invalid page selection
+    args:
+      pages: str, page selection, see parse_page_list
+      shard: tuple, (k, N), see shard_items
+    returns:
+      list of int, the selected page numbers of the shard
+    """
+    import pdfplumber
+
+    with pdfplumber.open(src_path) as pdf:
+        n_pages = len(pdf.pages)
+    return shard_items(parse_page_list(pages, n_pages), shard)
+
+
+def parse_pages(src_path, selected, workers, options, report, manifest, journal):
+    """
+    description:
+      crop the selected pages of a pdf, in the current process or on a pool of worker processes. Only the selected pages are opened, by their index.
+    args:
+      selected: list of int, the page numbers to crop, see select_pages
+      options: dict, keyword arguments of crop_pdf_page
+      report: MetricsSink, receives the metrics record of every page
+      manifest: Manifest, receives the files written for every page
+      journal: ProgressJournal, records every completed page, the pages it has done already are skipped
+    """
+    import pdfplumber
+    from tqdm import tqdm
+
+    with pdfplumber.open(src_path) as pdf:
+        n_pages = len(pdf.pages)
+        indices = [
+            page_num - 1 for page_num in selected if page_num not in journal.done
+        ]
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(src_path,)
+            )
+            results = ordered_map(
+                executor, _crop_pdf_page_worker, indices, options, 2 * workers
+            )
         else:
-            print(
-                "Invalid input path, the path should be a pdf or an image or a folder containing images."
+            executor = None
+            results = finish_in_order(
+                crop_pdf_page(pdf, i, **options) for i in indices
             )
-            return
-        print(f"Found {len(images)} image(s), processing begins...")
-        for i, img_path in enumerate(tqdm(images)):
-            # get all the bone tracings and page with bone tracings replaced by white background, see other file for details of the class
-            output = RubbingCropper(
-                img_path, text_threshold, mode=mode, padding=padding
-            ).output
-            for j, bone in enumerate(output["images"]):
-                box = output["boxes"][j]
-                save_name = f"{os.path.basename(img_path).split('.')[0]}-{[box[0], box[1], box[2], box[3]]}.png"
-                if not os.path.exists(save_path):
-                    os.makedirs(save_path)
-                if not os.path.exists(os.path.join(save_path, "images")):
-                    os.makedirs(os.path.join(save_path, "images"))
-                if not only_object and not os.path.exists(
-                    os.path.join(save_path, "pages")
-                ):
-                    os.makedirs(os.path.join(save_path, "pages"))
-                # save the bone tracings
-                Image.fromarray(bone).save(
-                    os.path.join(save_path, "images", save_name), dpi=(dpi, dpi)
-                )
-                # save the page with bone tracings replaced by white background
-                if not only_object:
-                    Image.fromarray(output["page"]).save(
-                        os.path.join(
-                            save_path,
-                            "pages",
-                            f"{os.path.basename(img_path).split('.')[0]}.png",
-                        ),
-                        dpi=(dpi, dpi),
-                    )
+        print(f"Processing begins for {len(indices)} of {n_pages} pages...")
+        try:
+            for entry, record in tqdm(results, total=len(indices)):
+                journal.append(entry)
+                manifest.add(entry)
+                report(record)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            close_writer()
+            close_ocr_pdf()
+        print(f"Processing finished!")
 
 
-if __name__ == "__main__":
-    # Usage example: python pdfcropper.py --src_pdf="../test/test.pdf" --dst_path="../output" --mode="poly" --dpi=600 --start_page=1 --text_threshold="200, 100" --only_object=True
+def list_images(src_path):
+    """
+    description:
+      the image files to be parsed, src_path itself if it is an image, or all the images in it if it is a folder
+    returns:
+      list of paths, or None if src_path is neither
+    """
+    # if is file and ends with image extension
+    if os.path.isfile(src_path) and (
+        src_path.endswith(".png")
+        or src_path.endswith(".jpg")
+        or src_path.endswith(".jpeg")
+        or src_path.endswith(".tif")
+        or src_path.endswith(".tiff")
+        or src_path.endswith(".bmp")
+        or src_path.endswith(".webp")
+    ):
+        return [src_path]
+    elif os.path.isdir(src_path):
+        # get all the images in the folder, sorted so that every run (and every shard) sees the same order
+        return [
+            os.path.join(src_path, f)
+            for f in sorted(os.listdir(src_path))
+            if f.endswith(".png")
+            or f.endswith(".jpg")
+            or f.endswith(".jpeg")
+            or f.endswith(".tif")
+            or f.endswith(".tiff")
+            or f.endswith(".bmp")
+            or f.endswith(".webp")
+        ]
+    return None
+
+
+def parse_images(images, workers, options, report, manifest, journal):
+    """
+    description:
+      crop a list of image files, in the current process or on a pool of worker processes
+    args:
+      options: dict, keyword arguments of crop_image
+      report: MetricsSink, receives the metrics record of every image
+      manifest: Manifest, receives the files written for every image
+      journal: ProgressJournal, see parse_pages
+    """
+    from tqdm import tqdm
+
+    # skip the images completed before, by their name, see crop_image
+    images = [
+        path
+        for path in images
+        if os.path.basename(path).split(".")[0] not in journal.done
+    ]
+    print(f"Found {len(images)} image(s), processing begins...")
+    if workers > 1 and len(images) > 1:
+        executor = ProcessPoolExecutor(workers)
+        results = ordered_map(
+            executor, _crop_image_worker, images, options, 2 * workers
+        )
+    else:
+        executor = None
+        results = finish_in_order(crop_image(path, **options) for path in images)
+    try:
+        for entry, record in tqdm(results, total=len(images)):
+            journal.append(entry)
+            manifest.add(entry)
+            report(record)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        close_writer()
+
+
+def positive_float(x):
+    # argparse type of the options which must be above 0, e.g. --detect_scale
+    value = float(x)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"must be positive, got {x}")
+    return value
+
+
+def build_parser():
+    # the command line options, shared with the jobs of cropper_service.py
     parser = argparse.ArgumentParser(
         description="Parse a pdf file and crop out the primary object as images"
     )
@@ -189,12 +926,26 @@ if __name__ == "__main__":
         required=False,
         help="the page number to end parsing, if not specified, will parse all pages",
     )
+    parser.add_argument(
+        "--pages",
+        type=str,
+        default=None,
+        required=False,
+        help="page selection, overriding start_page and end_page, comma separated pages and inclusive ranges where an open end runs to the last page. Example: 1-40,55,90-",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default="1/1",
+        required=False,
+        help="only process the k-th of N shards, written as k/N, the selected pages (or the sorted images of a folder) are dealt round robin to the shards so that every node agrees on the split. Every shard writes its own manifest into dst_path, combine them with merge_shards.py. Example: 2/8",
+    )
     parser.add_argument(
         "--text_threshold",
         type=str,
         default="250, 100",
         required=False,
-        help="the threshold for distinguishing the text and the rubbing (or Primary Object), in width and height, those smaller than the threshold will be considered a number text. Example: 200, 100. In my current version of pdf, the width for a 2-digit number is from 15-30 (depending whether there are postfixes like 正，反), the height is 10-20. For four or five digits, width might be 50-100. Also take into account the erosion morphing which will expand the number pixels depending on the kernal size used. So, give it a 50% to 100 percent reserve space.",
+        help="the threshold for distinguishing the text and the rubbing (or Primary Object), in width and height, those smaller than the threshold will be considered a number text. Example: 200, 100. In my current version of pdf, the width for a 2-digit number is from 15-30 (depending whether there are postfixes like 正，反), the height is 10-20. For four or five digits, width might be 50-100. Also take into account the erosion morphing which will expand the number pixels depending on the kernal size used. So, give it a 50%% to 100%% reserve space.",
     )
     parser.add_argument(
         "--only_object",
@@ -206,9 +957,172 @@ if __name__ == "__main__":
         help="if true, only the bone tracings will be saved, the page with bone tracings replaced by white background will not be saved",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="number of worker processes, each one opens the pdf by itself and renders, crops and saves whole pages. Output files are identical to the default single process mode, memory use grows with the number of workers as every worker holds its own page",
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        required=False,
+        help="optional folder for caching rendered pages and detection results of a pdf, so that re-runs over the same pdf with other text_threshold, mode or padding skip rendering and detection. The cache is keyed by the content of the pdf, the page and the dpi, and can be shared between pdfs and runs",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=str,
+        default="48, 1",
+        required=False,
+        help="size budget in GB of the cached pages and of the cached detection results, the least recently used entries are removed beyond it. Pages are stored compressed, about 0.5MB for a gray rubbing page and 22MB for a colour photo page at 600dpi, so the default holds a catalogue of 2000 colour pages. Example: 48, 1",
+    )
+
+    parser.add_argument(
+        "--detect_scale",
+        type=positive_float,
+        default=1,
+        required=False,
+        help="scale of the page used for detecting the objects, e.g. 0.25 runs the erosion and contour finding on a page shrunk by 4 times with a kernel shrunk to match, which is several times faster. The outlines of the selected objects are then traced again on their region of the full resolution page, so that boxes and crops match the full resolution detection, text_threshold keeps its full resolution meaning. Default is 1, detecting on the full resolution page",
+    )
+
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        required=False,
+        help="optional path of a jsonl file, for every page a record of the time spent in each stage (render, erode, threshold, find_contours, crop, save...), the number of contours before and after filtering, the bytes written and the peak memory is appended to it, useful for finding pathological pages",
+    )
+
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="png",
+        required=False,
+        help="output image format, png, webp (lossless) or tiff (deflate compressed), default is png",
+    )
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=6,
+        required=False,
+        help="compression level of the output from 0 to 9, the zlib level for png, mapped to the encoding effort for webp, 0 writes uncompressed tiff. Lower levels write faster but larger files, default is 6",
+    )
+    parser.add_argument(
+        "--writer_threads",
+        type=int,
+        default=2,
+        required=False,
+        help="number of threads encoding and writing the images of each process, so that writing overlaps with the processing of the next page, default is 2",
+    )
+
+    parser.add_argument(
+        "--resume",
+        type=lambda x: (str(x).lower() == "true"),
+        default=False,
+        required=False,
+        help="if true, continue an interrupted run into the same dst_path with the same options, pages recorded as completed in its progress journal (progress.jsonl) are skipped, the others are redone",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="raster",
+        required=False,
+        help="how pdf pages are turned into images, raster renders every page at dpi, embedded takes the scanned image of pages made of a single image directly at its native resolution (jpeg, ccitt fax, jpeg 2000 or raw samples), which skips the rendering and keeps the crops at the true scan resolution, other pages are still rendered. Note that text_threshold is in pixels of the scan then, default is raster",
+    )
+
+    parser.add_argument(
+        "--memory_budget",
+        type=int,
+        default=0,
+        required=False,
+        help="optional memory budget in MB per process for the images of a folder, images too large to be processed whole within it (e.g. gigapixel scans) are eroded, thresholded and traced by bands of rows, with the intermediate images kept in scratch files on disk, giving the same crops as processing them whole. Uncompressed tiff and pgm files are read by windows, other formats are decoded once. detect_scale is not applied to these images. Default is 0, processing every image whole",
+    )
+    parser.add_argument(
+        "--tile_threads",
+        type=int,
+        default=2,
+        required=False,
+        help="number of threads processing the bands of an image with --memory_budget, the budget is shared between them, default is 2",
+    )
+
+    parser.add_argument(
+        "--src_ocr",
+        type=str,
+        default=None,
+        required=False,
+        help='optional, number the bones of a pdf while cropping, by the words of "source" (the text layer of the pdf itself) or of an ocr pdf given by its path. Every bone is saved once as "{page}-{number}" instead of its box, as numbering.py would rename it, without reading the output again. Bones without a number left keep their box in the name',
+    )
+    parser.add_argument(
+        "--ocr_start_page",
+        type=int,
+        default=1,
+        required=False,
+        help="the page number in the pdf of the first page of the ocr pdf, change it if the ocr pdf does not start at the first page, default is 1",
+    )
+    parser.add_argument(
+        "--x_tolerance",
+        type=int,
+        default=8,
+        required=False,
+        help="with --src_ocr, x tolerance for merging adjacent characters into a number, set a higher value if some numbers are not merged into a single one, default is 8",
+    )
+
+    parser.add_argument(
+        "--pack",
+        type=str,
+        default=None,
+        required=False,
+        help="optional, tar or zip, pack the cropped objects into containers of about pack_size MB instead of writing one file each, with an index.jsonl of the page, box, polygon, dpi and byte offsets of every object, for reading any of them without unpacking (see PackReader in modules/pack.py). Pages are still written as files. Default is one file per object",
+    )
+    parser.add_argument(
+        "--pack_size",
+        type=int,
+        default=1024,
+        required=False,
+        help="with --pack, size in MB from which a new container is started, default is 1024",
+    )
+
+    parser.add_argument(
+        "--bilevel",
+        type=lambda x: str(x).lower(),
+        choices=["auto", "true", "false"],
+        default="false",
+        required=False,
+        help="auto, true or false. With auto, pages which are only black and white (e.g. 1-bit or CCITT fax scans, with --backend=embedded for pdfs) are kept bit-packed once detected, and their objects and pages are written as 1-bit png or tiff G4, 8 times less memory and much smaller files, with the same pixels. With true, every page is also thresholded into black and white after the detection, colours and gray levels are lost. The detection is the same either way. Not applied to images processed by bands (--memory_budget). Default is false",
+    )
+
+    parser.add_argument(
+        "--detect_only",
+        type=lambda x: (str(x).lower() == "true"),
+        default=False,
+        required=False,
+        help="if true, only detect the objects, for tuning text_threshold, mode, detect_scale... on a new pdf at a fraction of the cost of a full run. Nothing is cropped, whitened or written, the size, number of contours, boxes and simplified polygons (and numbers with --src_ocr) of every page are written as one json line per page to detections.jsonl in dst_path instead, default is false",
+    )
+    parser.add_argument(
+        "--overlay_size",
+        type=int,
+        default=0,
+        required=False,
+        help="with --detect_only, also write a thumbnail of every page with the boxes (blue) and polygons (red) drawn over it into the overlays subfolder, this is the length of its longest side in pixels, e.g. 1024, default is 0, no overlays",
+    )
+
+    return parser
+
+
+def main(args):
+    """
+    description:
+      run parse_pdf with the options parsed by build_parser
+    returns:
+      dict, the manifest of the run, see parse_pdf
+    """
     text_threshold = tuple([int(i.strip()) for i in args.text_threshold.split(",")])
-    parse_pdf(
+    cache_size = tuple([float(i.strip()) for i in args.cache_size.split(",")])
+    return parse_pdf(
         args.src_path,
         args.dst_path,
         args.mode,
@@ -218,4 +1132,32 @@ if __name__ == "__main__":
         args.dpi,
         text_threshold,
         args.only_object,
+        args.workers,
+        args.cache_dir,
+        cache_size,
+        args.detect_scale,
+        args.metrics_path,
+        None,
+        args.format,
+        args.compress_level,
+        args.writer_threads,
+        args.pages,
+        parse_shard(args.shard),
+        args.resume,
+        args.backend,
+        args.memory_budget,
+        args.tile_threads,
+        args.src_ocr,
+        args.ocr_start_page,
+        args.x_tolerance,
+        args.pack,
+        args.pack_size,
+        {"true": True, "false": False}.get(args.bilevel, args.bilevel),
+        args.detect_only,
+        args.overlay_size,
     )
+
+
+if __name__ == "__main__":
+    # Usage example: python pdfcropper.py --src_pdf="../test/test.pdf" --dst_path="../output" --mode="poly" --dpi=600 --start_page=1 --text_threshold="200, 100" --only_object=True
+    main(build_parser().parse_args())
@@ -0,0 +1,68 @@
+import os
+import sys
+import numpy as np
+import pdfplumber
+
+# import local modules, runs from the repository root (python -m pytest test) or from this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from modules.cropper import PageDetection
+from modules.render import render_page
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PDFS = ["test.pdf", "test-color.pdf"]
+DPI = 600
+# the supported detection scales, and the tolerance of their boxes in full resolution pixels. The outlines are refined at full resolution, only the threshold level of the shrunk page may differ by a gray level or so
+SCALES = [0.5, 0.25, 0.125]
+TOLERANCE = {scale: 2 for scale in SCALES}
+
+
+def box_edges(boxes):
+    # (x0, y0, x1, y1) of (x, y, w, h) boxes
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], 1)
+
+
+def unmatched_boxes(full, scaled, tolerance):
+    """
+    description:
+      the boxes of a detection (e.g. the full resolution one) with no box of the other detection (e.g. the downscaled one) whose edges are all within tolerance pixels of theirs
+    returns:
+      list of (box, distance to the closest box of the other detection in pixels)
+    """
+    full_edges, scaled_edges = box_edges(full), box_edges(scaled)
+    if len(scaled_edges) == 0:
+        return [(tuple(box), None) for box in full]
+    distances = np.abs(full_edges[:, None, :] - scaled_edges[None, :, :]).max(2).min(1)
+    return [
+        (tuple(box), int(distance))
+        for box, distance in zip(full, distances)
+        if distance > tolerance
+    ]
+
+
+def test_detect_scale_boxes():
+    for pdf_name in PDFS:
+        with pdfplumber.open(os.path.join(TEST_DIR, pdf_name)) as pdf:
+            for page in pdf.pages:
+                image = np.asarray(render_page(page, DPI)[0])
+                full = PageDetection(image).select().boxes
+                for scale in SCALES:
+                    scaled = PageDetection(image, scale).select().boxes
+                    label = f"{pdf_name} page {page.page_number} detect_scale={scale}"
+                    missed = unmatched_boxes(full, scaled, TOLERANCE[scale])
+                    assert not missed, (
+                        f"{label}: no box within {TOLERANCE[scale]}px of {missed}"
+                    )
+                    # and no extra box either
+                    extra = unmatched_boxes(scaled, full, TOLERANCE[scale])
+                    assert not extra, (
+                        f"{label}: no full resolution box within {TOLERANCE[scale]}px of {extra}"
+                    )
+                    assert len(scaled) == len(full), label
+                page.close()
+
+
+if __name__ == "__main__":
+    # Usage example: python test_detect_scale.py
+    test_detect_scale_boxes()
+    print(f"The full resolution and downscaled boxes match within {TOLERANCE} pixels")
@@ -0,0 +1,44 @@
+import os
+import sys
+import subprocess
+
+# import the scripts, which import local modules from .. of their own folder
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+sys.path.append(SCRIPTS_DIR)
+sys.path.append(os.path.join(SCRIPTS_DIR, ".."))
+import numbering
+import pdfcropper
+
+SCRIPTS = [
+    "pdfcropper.py",
+    "numbering.py",
+    "merge_shards.py",
+    "benchmark.py",
+    "cropper_service.py",
+]
+
+
+def test_build_parser_help():
+    # argparse formats the help strings with %, a bare % in one of them breaks --help
+    for script in [pdfcropper, numbering]:
+        assert "--src" in script.build_parser().format_help()
+
+
+def test_scripts_help():
+    for script in SCRIPTS:
+        result = subprocess.run(
+            [sys.executable, script, "--help"],
+            cwd=SCRIPTS_DIR,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        assert result.returncode == 0, f"{script} --help failed:\n{result.stderr}"
+        assert "usage:" in result.stdout, script
+
+
+if __name__ == "__main__":
+    # Usage example: python test_help.py
+    test_build_parser_help()
+    test_scripts_help()
+    print("Every script prints its help")
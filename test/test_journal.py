@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+# import the scripts, which import local modules from .. of their own folder
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+sys.path.append(SCRIPTS_DIR)
+sys.path.append(os.path.join(SCRIPTS_DIR, ".."))
+from pdfcropper import parse_pdf
+
+TEST_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.pdf")
+INVALID_PAGES = ["abc", "3-1", "90-"]
+
+
+def test_invalid_pages_keep_journal():
+    # an invalid page selection is rejected before the progress journal of the previous run is opened
+    with tempfile.TemporaryDirectory() as save_path:
+        parse_pdf(TEST_PDF, save_path, dpi=50, end_page=2)
+        journal_path = os.path.join(save_path, "progress.jsonl")
+        with open(journal_path, "rb") as f:
+            journal = f.read()
+        for pages in INVALID_PAGES:
+            for resume in [False, True]:
+                try:
+                    parse_pdf(TEST_PDF, save_path, dpi=50, pages=pages, resume=resume)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError(f"pages={pages!r} was accepted")
+                with open(journal_path, "rb") as f:
+                    assert f.read() == journal, f"pages={pages!r} resume={resume}"
+
+
+if __name__ == "__main__":
+    # Usage example: python test_journal.py
+    test_invalid_pages_keep_journal()
+    print("Invalid page selections keep the progress journal")
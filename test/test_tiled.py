@@ -0,0 +1,64 @@
+import os
+import sys
+import numpy as np
+
+# import local modules, runs from the repository root (python -m pytest test) or from this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from modules.cropper import RubbingCropper
+from modules.tiled import TiledCropper
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES = ["test.jpg", "test-color.jpg"]
+THRESHOLDS = [(300, 200), (200, 150), (100, 50), (60, 30), (20, 10)]
+# a single band, and bands of a few dozen rows, so that objects cross the seams
+MEMORY_BUDGETS = [1024, 1]
+
+
+def compare(img_input, threshold, memory_mb):
+    """
+    description:
+      run TiledCropper and RubbingCropper on the same image, and check that the boxes, crops and whitened page are the same
+    """
+    whole = RubbingCropper(img_input, threshold).output
+    cropper = TiledCropper(img_input, threshold, memory_mb=memory_mb, threads=2)
+    try:
+        name = img_input if isinstance(img_input, str) else f"array {img_input.shape}"
+        label = f"{name} {threshold} memory_mb={memory_mb}"
+        assert [tuple(box) for box in cropper.boxes] == [
+            tuple(box) for box in whole["boxes"]
+        ], label
+        images = list(cropper.output["images"])
+        assert len(images) == len(whole["images"]), label
+        for tiled_image, image in zip(images, whole["images"]):
+            assert np.array_equal(tiled_image, image), label
+        assert np.array_equal(np.asarray(cropper.output["page"]), whole["page"]), label
+    finally:
+        cropper.close()
+
+
+def test_tiled_matches_whole():
+    for image in IMAGES:
+        for threshold in THRESHOLDS:
+            for memory_mb in MEMORY_BUDGETS:
+                compare(os.path.join(TEST_DIR, image), threshold, memory_mb)
+
+
+def test_tiled_blank_pages():
+    # pages with no component of one colour, blank white or black, and white objects on a black page
+    white = np.full((400, 300), 255, dtype=np.uint8)
+    black = np.zeros((400, 300), dtype=np.uint8)
+    dark = black.copy()
+    dark[100:200, 50:150] = 255
+    dark[250:300, 180:260] = 255
+    for page in [white, black, dark]:
+        for img_input in [page, np.stack([page] * 3, 2)]:
+            for threshold in THRESHOLDS:
+                for memory_mb in [1024, 0.05]:
+                    compare(img_input, threshold, memory_mb)
+
+
+if __name__ == "__main__":
+    # Usage example: python test_tiled.py
+    test_tiled_matches_whole()
+    test_tiled_blank_pages()
+    print("TiledCropper matches RubbingCropper")